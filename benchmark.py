@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set file encoding=utf-8 :
+
+# file: 'benchmark.py'
+"""
+benchmark.py
+
+Measures the throughput of format_change.py against a synthetic
+RACHEL-like directory tree, using a stub encoder in place of avconv.
+
+Usage:
+    benchmark.py -h | --version
+    benchmark.py [options]
+
+Options:
+  -h --help        Print this docstring.
+  --version        Provide version information.
+  --html=N         Number of html pages.  [Default: 200]
+  --videos=N       Number of videos (mp4 and flv alternately.)
+                                            [Default: 20]
+  --assets=N       Number of other files (images, scripts etc.)
+                                            [Default: 500]
+  --html-size=BYTES    Size of each html page.  [Default: 20000]
+  --video-size=BYTES   Size of each video.  [Default: 2000000]
+  --asset-size=BYTES   Size of each other file.  [Default: 50000]
+  --dirs=N         Number of module directories.  [Default: 10]
+  --latency=SECONDS    Time the stub encoder takes per video.
+                                            [Default: 0.2]
+  -j N --jobs=N    Concurrent conversions.  [Default: 1]
+  --modes=MODES    Comma separated list of the modes to measure:
+                    in-place and/or out-dir.  [Default: in-place,out-dir]
+  --extra=OPTIONS  Further options for format_change.py (quoted.)
+                                            [Default: ]
+  -r FILE --results=FILE   Where the results are kept (as JSON.)
+                                [Default: benchmark-results.json]
+  -c FILE --compare=FILE   Results of an earlier run to compare with.
+  -w DIR --work-dir=DIR    Directory in which the trees are built;
+                    a temporary one (removed afterwards) if not given.
+  --measure=MODE   (Internal) measure one mode (its tree already
+                    built) in this process.
+
+For each mode a fresh tree is built and format_change.py's
+traverse_and_change is then run against it in a separate process (so
+that peak memory use is that of traverse_and_change alone, not of
+building the tree.)  Peak memory use is read from /proc where there
+is one (ru_maxrss carries over a parent's through fork and exec) and
+the stub encoder reports its own.  Files/sec and bytes/sec are of the
+whole tree; the per-phase wall times are those kept by
+traverse_and_change.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shlex
+import shutil
+import datetime
+import tempfile
+import resource
+import subprocess
+from docopt import docopt
+
+import format_change
+
+VERSION = 'v0.1.0'
+STUB_ENCODER = '''#!{python}
+# Stub encoder for benchmark.py: behaves (roughly) like avconv and
+# adds its peak memory use (KB, see peak_rss_kb) to {rss_file!r}.
+import sys, time, shutil, resource
+arguments = sys.argv[1:]
+time.sleep({latency})
+shutil.copyfile(arguments[arguments.index('-i') + 1], arguments[-1])
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+try:
+    with open('/proc/self/status') as f:
+        peak = next(int(line.split()[1]) for line in f
+                    if line.startswith('VmHWM:'))
+except (OSError, StopIteration):
+    pass
+with open({rss_file!r}, 'a') as f:
+    f.write('{{}}\\n'.format(peak))
+'''
+PAGE = '''<html><head><title>Module {module} page {page}</title></head>
+<body>
+<video controls><source src="{video}" type="video/mp4"></video>
+<a href="../module-{other}/{video}">same video elsewhere</a>
+<img src="asset-{page}.png"><p>{padding}</p>
+</body></html>
+'''
+PROFILE = 'bench'
+CHUNK_SIZE = 1 << 20  # Bytes of a synthetic file generated at a time.
+
+
+def peak_rss_kb():
+    """Returns the peak memory use (KB) of this process.
+
+    On Linux ru_maxrss carries over the peak of the process that
+    forked (and exec'd) this one, so VmHWM is read from /proc where
+    there is one.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def write_file(path, size, rand):
+    """Writes <size> pseudo random bytes to <path>, a CHUNK_SIZE at a
+    time."""
+    with open(path, 'wb') as f:
+        while size > 0:
+            n = min(size, CHUNK_SIZE)
+            f.write(rand.getrandbits(8 * n).to_bytes(n, 'little'))
+            size -= n
+
+def build_tree(root, args):
+    """Builds the synthetic tree under <root>.
+
+    Files are spread over args['--dirs'] module directories each
+    with a sub directory of videos.
+    """
+    rand = random.Random(0)
+    n_dirs = int(args['--dirs'])
+    modules = [os.path.join(root, 'module-{}'.format(i))
+                for i in range(n_dirs)]
+    for module in modules:
+        os.makedirs(os.path.join(module, 'videos'))
+    videos = []
+    for i in range(int(args['--videos'])):
+        name = 'videos/video-{}{}'.format(i, ('.mp4', '.flv')[i % 2])
+        write_file(os.path.join(modules[i % n_dirs], name),
+                    int(args['--video-size']), rand)
+        videos.append(name)
+    for i in range(int(args['--assets'])):
+        write_file(os.path.join(modules[i % n_dirs],
+                                'asset-{}.png'.format(i)),
+                    int(args['--asset-size']), rand)
+    for i in range(int(args['--html'])):
+        page = PAGE.format(module=i % n_dirs, page=i,
+                    video=videos[i % len(videos)] if videos else '',
+                    other=(i + 1) % n_dirs, padding='')
+        padding = 'x' * max(0, int(args['--html-size']) - len(page))
+        with open(os.path.join(modules[i % n_dirs],
+                                'page-{}.html'.format(i)), 'w') as f:
+            f.write(page.replace('<p></p>',
+                                '<p>{}</p>'.format(padding)))
+
+def count_tree(root):
+    """Returns the number of files and of bytes under <root>."""
+    n_files = n_bytes = 0
+    for directory, _, files in os.walk(root):
+        for file_name in files:
+            n_files += 1
+            n_bytes += os.path.getsize(os.path.join(directory, file_name))
+    return n_files, n_bytes
+
+def write_stub(work_dir, args):
+    """Writes the stub encoder and a profiles file naming it.
+    Returns the path of the profiles file and that of the file the
+    stub adds its peak memory use to."""
+    stub = os.path.join(work_dir, 'stub-encoder')
+    rss_file = os.path.join(work_dir, 'encoder-rss')
+    with open(stub, 'w') as f:
+        f.write(STUB_ENCODER.format(python=sys.executable,
+                                    latency=float(args['--latency']),
+                                    rss_file=rss_file))
+    os.chmod(stub, 0o755)
+    profiles = os.path.join(work_dir, 'profiles.json')
+    with open(profiles, 'w') as f:
+        json.dump({PROFILE: dict(suffix='.webm', encoders=[stub],
+                                arguments=[], presets=dict(default=[]))},
+                    f)
+    return profiles, rss_file
+
+def measure(mode, work_dir, args):
+    """Runs traverse_and_change against the tree built (see
+    build_tree) for <mode> ('in-place' or 'out-dir') in <work_dir>
+    and returns a dictionary of the results."""
+    tree = os.path.join(work_dir, mode, 'input')
+    n_files, n_bytes = count_tree(tree)
+    profiles, rss_file = write_stub(os.path.join(work_dir, mode), args)
+    argv = ['--input', tree, '--format', PROFILE,
+            '--profiles', profiles,
+            '--jobs', args['--jobs'],
+            '--logfile', os.path.join(work_dir, mode, 'conv.log'),
+            '--statusfile', os.path.join(work_dir, mode, 'status'),
+            '--state', os.path.join(work_dir, mode, 'state.db')]
+    if mode == 'in-place':
+        argv.append('--in-place')
+    else:
+        argv.extend(['--output', os.path.join(work_dir, mode, 'output')])
+    argv.extend(shlex.split(args['--extra']))
+    fc_args = format_change.get_args(argv)
+    begin = time.perf_counter()
+    format_change.start_logging(fc_args)
+    format_change.traverse_and_change(fc_args)
+    format_change.stop_logging(fc_args)
+    wall = time.perf_counter() - begin
+    with open(rss_file, 'a+') as f:
+        f.seek(0)
+        encoder_peaks = [int(line) for line in f]
+    return dict(files=n_files, bytes=n_bytes,
+                wall_seconds=wall,
+                files_per_second=n_files / wall,
+                bytes_per_second=n_bytes / wall,
+                peak_rss_kb=peak_rss_kb(),
+                children_peak_rss_kb=max(encoder_peaks, default=0),
+                phases=fc_args['phase_times'])
+
+def get_comparison(results, earlier):
+    """Returns a table comparing <results> with <earlier> ones."""
+    lines = ["Compared with the results of {}:".format(
+                                                earlier['date'])]
+    for mode, figures in sorted(results['modes'].items()):
+        if not mode in earlier['modes']:
+            continue
+        before = earlier['modes'][mode]
+        for key in ('files_per_second', 'bytes_per_second',
+                    'peak_rss_kb', 'wall_seconds'):
+            if before.get(key):
+                lines.append("    {:9} {:18} {:14,.1f} => {:14,.1f} ({:+.1%})"
+                    .format(mode, key, before[key], figures[key],
+                            figures[key] / before[key] - 1))
+    return '\n'.join(lines)
+
+def get_summary(results):
+    """Returns the results in readable form."""
+    lines = []
+    for mode, figures in sorted(results['modes'].items()):
+        lines.append("""{}: {:,} files, {:,} bytes in {:.2f}s
+    {:,.1f} files/sec, {:,.0f} bytes/sec, peak RSS {:,} KB (encoders {:,} KB)
+    phases: {}""".format(mode, figures['files'], figures['bytes'],
+                figures['wall_seconds'], figures['files_per_second'],
+                figures['bytes_per_second'], figures['peak_rss_kb'],
+                figures['children_peak_rss_kb'],
+                ', '.join("{} {:.2f}s".format(phase, seconds)
+                    for phase, seconds in figures['phases'].items())))
+    return '\n'.join(lines)
+
+def main(args):
+    if args['--measure']:
+        print(json.dumps(measure(args['--measure'], args['--work-dir'],
+                                args)))
+        return
+    work_dir = args['--work-dir'] or tempfile.mkdtemp(prefix='bench-')
+    results = dict(date=str(datetime.datetime.now())[:19],
+                    parameters={key: value for key, value in args.items()
+                        if not key in ('--measure', '--compare',
+                                        '--results', '--work-dir')},
+                    modes={})
+    try:
+        for mode in args['--modes'].split(','):
+            if os.path.exists(os.path.join(work_dir, mode)):
+                shutil.rmtree(os.path.join(work_dir, mode))
+            build_tree(os.path.join(work_dir, mode, 'input'), args)
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__),
+                '--measure', mode, '--work-dir', work_dir]
+                + [argument for key, value in args.items()
+                    if key.startswith('--') and value is not None
+                        and not key in ('--measure', '--work-dir',
+                                        '--compare', '--results',
+                                        '--help', '--version')
+                    for argument in (key, str(value))])
+            results['modes'][mode] = json.loads(
+                                        output.decode().splitlines()[-1])
+    finally:
+        if not args['--work-dir']:
+            shutil.rmtree(work_dir)
+    print(get_summary(results))
+    if args['--compare']:
+        with open(args['--compare']) as f:
+            print(get_comparison(results, json.load(f)))
+    with open(args['--results'], 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__, version=VERSION)
+    main(args)
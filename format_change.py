@@ -9,8 +9,10 @@ format_change.py
 
 Usage:
     format_change.py -h | --version
+    format_change.py [options] --list-profiles
     format_change.py [options] -o OUT_DIR
     format_change.py [options] --in-place
+    format_change.py [options] --work=QUEUE_DIR
 
 Options:
   -h --help        Print this docstring.
@@ -19,96 +21,600 @@ Options:
   -v --verbose     Provides progress information.
   -l LOGFILE --logfile=LOGFILE  Specify log file.
                                             [Default: /tmp/conv.log]
+  --log-format=LOGFORMAT   Either text or json (one JSON object per
+                                line.)  [Default: text]
   -s STATUSFILE --statusfile=STATUSFILE   Specify a status file.
                                           [Default: .status-report]
-  -f FORMAT --format=FORMAT   Format desired. Currently only ogv and 
-                                webm are supported. [Default: webm]
+  --state=STATEFILE   Specify the state database that remembers
+                    conversions across runs.  [Default: .conversion-state.db]
+  --incremental-html   Only deal with html files that are new, have
+                    changed or refer to a video whose conversion has
+                    (or has newly failed) since they were last dealt
+                    with.
+  --skip-unchanged   Don't look at the files of a directory the state
+                    database shows to have been completely dealt with
+                    and to have had no file added, removed or renamed
+                    since (its mtime is unchanged.)
+  -f FORMAT --format=FORMAT   Format desired: the name of an encoder
+                    profile (see --list-profiles.)  [Default: webm]
+  --preset=PRESET   Quality/speed preset of the profile.
+                                            [Default: default]
+  --encoder=ENCODER   Encoder program to use (avconv, ffmpeg) or auto
+                    for the first of the profile's that is installed.
+                                            [Default: auto]
+  --threads=THREADS   Threads per encoder process or auto (the
+                    profile's setting, else the cores shared out
+                    between --jobs.)  [Default: auto]
+  --profiles=PROFILES_FILE   JSON file of additional (or replacement)
+                    encoder profiles.
+  --list-profiles   List the encoder profiles and presets available.
   -i IN_DIR --input=IN_DIR   Directory under which the html and mp4
                                     files are found. [Default: ./]
   -o OUT_DIR --output=OUT_DIR    Destination directory which will be
                                 created if it doesn't already exist. 
   --in-place    Make changes to the source directory rather than 
                               creating a new one.
+  --cache-dir=CACHE_DIR   Keep converted videos in CACHE_DIR so that
+                    identical sources are only converted once.
+  --cache-size=MEGS   Size beyond which the least recently used
+                    entries are removed from the cache.  [Default: 10000]
+  --link-mode=MODE   How files that need no change get into OUT_DIR:
+                    copy, hardlink, reflink, symlink or auto (reflink
+                    or hardlink where possible.)  [Default: copy]
+  -j N --jobs=N    Number of video conversions to run concurrently.
+                                            [Default: 1]
+  --engine=ENGINE   Execution engine: pool (plan everything, then
+                    run the encoders from a polling loop) or async
+                    (an asyncio pipeline.)  [Default: pool]
+  --order=ORDER    Order in which videos are converted: largest,
+                    smallest (first) or walk.  [Default: largest]
+  -p --progress    Show files and video bytes done, the encode rate
+                    and an ETA (on stderr) as the work goes on.
+  --progress-file=PROGRESS_FILE   Periodically write the same (as
+                    JSON) to PROGRESS_FILE.
+  --queue=QUEUE_DIR   Coordinate: rather than converting videos
+                    here, serve them as jobs (through QUEUE_DIR, on
+                    storage shared with the workers) to workers.
+  --work=QUEUE_DIR   Work: convert the videos served through
+                    QUEUE_DIR (up to --jobs at a time) until the
+                    coordinator is done.
+  --lease-timeout=SECONDS   Time after which a job whose worker has
+                    stopped reporting is given to another.
+                                            [Default: 300]
+  --worker-id=NAME   Name of this worker.  [Default: <host>-<pid>]
+  --probe=PROBER   Program (ffprobe, avprobe) used to inspect each
+                    video before converting it, auto for the one going
+                    with the encoder (if installed) or none.
+                                            [Default: auto]
+  --max-growth=RATIO   Give up on (and kill) a conversion as soon as
+                    its output is larger than RATIO times its source.
+  --min-free=MEGS   Space to be left free on the device OUT_DIR is
+                    on: conversions wait (or, if none is running, are
+                    given up) rather than use it.  [Default: 100]
+  --delete-originals   (With --in-place) delete each original video
+                    as soon as its conversion succeeds.
+  --profile        Write timings of each phase of the work (see
+                    below) to LOGFILE.profile.json.
+  --cprofile       Also write cProfile statistics to LOGFILE.pstats.
+  -n --dry-run     Print what would be done and an estimate of how
+                    long it would take, without doing any of it.
+  --time-per-meg=SECONDS   Conversion time per meg of original format
+                    assumed for estimates.  [Default: 30]
 
 This script traverses the IN_DIR directory (or current working
 directory if none is provided) looking for non proprietary video files.
 Those found, are converted to the format specified by FORMAT.
-To date, this script supports conversion of only mp4 and flv videos to
-webm (the default) or ogv format.
+To date, this script supports conversion of only mp4 and flv videos.
+Formats are described by encoder profiles: webm (the default,) ogv,
+webm-vp9 and ogg-audio are built in and more can be added with --profiles.
+A profile is a JSON object such as:
+    {"webm-fast": {"suffix": ".webm",
+                   "encoders": ["ffmpeg", "avconv"],
+                   "input_arguments": [],
+                   "arguments": ["-c:v", "libvpx", "-c:a", "libvorbis"],
+                   "presets": {"default": ["-deadline", "realtime"]},
+                   "audio_arguments": ["-vn", "-c:a", "libvorbis"],
+                   "threads": 2}}
+("threads" may be omitted, "auto" or a number; "audio_arguments", if
+present, replace "arguments" and the preset for sources found by the
+probe to have no video stream.)
+Before a video is converted it is probed (see --probe) for its
+streams, duration and bit rate: one that can't be read is failed at
+once, without running the encoder.  Probe results are kept in
+STATEFILE.
 In order that links remain unbroken, html files are also scanned and
-where need be, the links are renamed as appropriate.
+where need be, the links are renamed as appropriate: once the videos
+are done, and only links to videos actually converted (as recorded in
+STATEFILE, which also keeps which videos each html file refers to-
+see --incremental-html.)
 If OUT_DIR is specified, another directory structure is created
 incorporating the changes, leaving the original unchanged.  If it
 already exists, its content is updated (i.e. work previously done is not
 repeated.)
 If --in-place is specified, original files are modified.
+A record of every conversion attempted is kept in STATEFILE so that a
+rerun only skips videos that were completely converted and haven't
+changed since.  Conversions are written under a temporary name and
+only renamed into place once the encoder succeeds.
+The input directory is first scanned to plan the work (see --dry-run)
+which is then carried out.
+With --profile, the time taken by each of: walk, stat, html_read,
+html_rewrite, html_write, copy, probe, encoder_spawn, encoder_runtime,
+log and log_io is recorded, and summarized (count, total, p50, p95,
+max) for the whole run and per directory.
+Video conversions are run as background processes (up to N of them
+at a time if --jobs is specified) so that plain copies continue to be
+dealt with while the encoders are busy.
+A conversion is only started if the device OUT_DIR is on has room for
+it (its output is estimated from the growth seen in earlier
+conversions of the same suffix) as well as for what the conversions
+already running are yet to write, and --min-free.  When it hasn't,
+smaller videos are started first or, failing that, the conversion
+waits for those running to finish.  A video there is no room for even
+then is given up (and, in OUT_DIR, not copied there either.)
+Videos can also be converted by workers on other machines (or other
+processes on this one:) the coordinator (--queue) plans the work, puts
+one job file per video in QUEUE_DIR/pending and deals with html files
+and copies itself while workers (--work) claim jobs by moving them to
+QUEUE_DIR/leased, touch them while converting and leave their results
+in QUEUE_DIR/done.  A lease not touched for --lease-timeout seconds is
+put back in pending.  QUEUE_DIR, IN_DIR and OUT_DIR must be seen under
+the same paths by coordinator and workers.
+The async engine pipelines the work instead: the directory walk feeds
+the encoders and a pool of threads dealing with copies (and, once the
+encoders are done, html files) through bounded queues.  Videos are then
+converted in walk order.  Interrupting it (Ctrl-C) kills the running
+encoders and removes their partial output.
 At completion, a report is presented outlining time taken and extra
 disk space required expressed in various ways.
+The same can be done from Python: convert(Config(input=..., output=...))
+returns the report and the Stats kept for each proprietary suffix.
+Each call keeps its own state so calls can run in separate threads.
 """
 
 import os
+import re
 import sys
-import shlex
+import glob
 import shutil
+import stat
+import sqlite3
+import hashlib
+import socket
+import mmap
+import fcntl
+import time
 import datetime
 import subprocess
-from docopt import docopt
+import collections
+import threading
+import atexit
+import signal
+import json
+import cProfile
+import contextlib
+import urllib.parse
 
 VERSION = 'v0.1.0'
 PROPRIETARY_SUFFIXES = ('.mp4', '.flv',)
-ENCODING = "latin-1"
+CHUNK_SIZE = 1 << 20  # Bytes read at a time when mmap isn't available.
+POLL_INTERVAL = 0.1  # Seconds between checks on running conversions.
+IO_THREADS = 4  # Threads rewriting html and copying (async engine.)
+QUEUE_SIZE = 64  # Items a stage may get ahead of the next (async.)
+PARTIAL_PREFIX = '.partial.'  # Marks conversions still in progress.
+LOG_FLUSH_BYTES = 65536  # Buffered log data that triggers a write.
+LOG_FLUSH_SECONDS = 2.0  # Longest time log data stays buffered.
+LINK_MODES = ('copy', 'hardlink', 'reflink', 'symlink', 'auto')
+PROGRESS_INTERVAL = 1.0  # Seconds between updates of the display.
+PROGRESS_SNAPSHOT_SECONDS = 10.0  # Seconds between progress snapshots.
+PROGRESS_WINDOW = 600.0  # Seconds over which the encode rate is taken.
+PROBERS = {'ffmpeg': 'ffprobe', 'avconv': 'avprobe'}  # Encoder: prober.
+PROBE_TIMEOUT = 60  # Seconds after which a source is deemed unreadable.
+PROBE_FAILURE = 'unreadable'  # Return codes given to jobs that fail
+GROWTH_FAILURE = 'outgrown'  # without the encoder failing.
+SPACE_FAILURE = 'no room'
+LOST_FAILURE = 'output lost'
+DEFAULT_GROWTH = 1.5  # Output/source size assumed until some are known.
+FICLONE = 0x40049409  # Linux ioctl to share (reflink) a file's data.
+ENCODER_PROFILES = {
+    'webm': {
+        'suffix': '.webm',
+        'encoders': ['avconv', 'ffmpeg'],
+        'input_arguments': ['-flags', 'qscale', '-global_quality', '1'],
+        'arguments': [],
+        'presets': {
+            'default': [],
+            'fast': ['-deadline', 'realtime', '-cpu-used', '8'],
+            'small': ['-deadline', 'good', '-cpu-used', '0'],
+            },
+        'audio_arguments': ['-vn', '-c:a', 'libvorbis', '-q:a', '4'],
+        },
+    'ogv': {
+        'suffix': '.ogv',
+        'encoders': ['avconv', 'ffmpeg'],
+        'input_arguments': ['-flags', 'qscale', '-global_quality', '1'],
+        'arguments': ['-acodec', 'libvorbis'],
+        'presets': {
+            'default': [],
+            'fast': ['-q:v', '5', '-q:a', '3'],
+            'small': ['-q:v', '4', '-q:a', '2'],
+            },
+        'audio_arguments': ['-vn', '-c:a', 'libvorbis', '-q:a', '4'],
+        },
+    'webm-vp9': {
+        'suffix': '.webm',
+        'encoders': ['ffmpeg', 'avconv'],
+        'input_arguments': [],
+        'arguments': ['-c:v', 'libvpx-vp9', '-b:v', '0',
+                        '-c:a', 'libopus'],
+        'presets': {
+            'default': ['-crf', '33', '-deadline', 'good',
+                        '-cpu-used', '2'],
+            'fast': ['-crf', '36', '-deadline', 'realtime',
+                        '-cpu-used', '8', '-row-mt', '1'],
+            'small': ['-crf', '40', '-deadline', 'good',
+                        '-cpu-used', '0'],
+            },
+        'audio_arguments': ['-vn', '-c:a', 'libopus', '-b:a', '64k'],
+        },
+    'ogg-audio': {
+        'suffix': '.ogg',
+        'encoders': ['avconv', 'ffmpeg'],
+        'input_arguments': [],
+        'arguments': ['-vn', '-c:a', 'libvorbis'],
+        'presets': {
+            'default': ['-q:a', '4'],
+            'fast': ['-q:a', '3'],
+            'small': ['-q:a', '1'],
+            },
+        'threads': 1,
+        },
+    }
 
-def get_args():
+class ConfigError(ValueError):
+    """Raised when options (see set_up_args) can't be used."""
+
+
+class Config:
+    """The options of the command line (see the module docstring) as
+    attributes: names are those of the long options with '_' for
+    '-' (in_place for --in-place.)  Used instead of the command line
+    when converting from Python (see convert.)
+
+    Config(input='/media/rachel', output='/media/out', jobs=4)
+    """
+    debug: bool = False
+    verbose: bool = False
+    logfile: str = '/tmp/conv.log'
+    log_format: str = 'text'
+    statusfile: str = '.status-report'
+    state: str = '.conversion-state.db'
+    incremental_html: bool = False
+    skip_unchanged: bool = False
+    format: str = 'webm'
+    preset: str = 'default'
+    encoder: str = 'auto'
+    threads: 'int | str' = 'auto'
+    profiles: 'str | None' = None
+    list_profiles: bool = False
+    input: str = './'
+    output: 'str | None' = None
+    in_place: bool = False
+    cache_dir: 'str | None' = None
+    cache_size: float = 10000
+    link_mode: str = 'copy'
+    jobs: int = 1
+    engine: str = 'pool'
+    order: str = 'largest'
+    progress: bool = False
+    progress_file: 'str | None' = None
+    queue: 'str | None' = None
+    work: 'str | None' = None
+    lease_timeout: float = 300
+    worker_id: str = '<host>-<pid>'
+    probe: str = 'auto'
+    max_growth: 'float | None' = None
+    min_free: float = 100
+    delete_originals: bool = False
+    profile: bool = False
+    cprofile: bool = False
+    dry_run: bool = False
+    time_per_meg: float = 30
+
+    def __init__(self, **options):
+        for name, value in options.items():
+            if not name in Config.__annotations__:
+                raise TypeError("'{}' is not an option.".format(name))
+            setattr(self, name, value)
+
+    def to_args(self):
+        """Returns the options as docopt would (see set_up_args.)"""
+        args = {'--help': False, '--version': False}
+        for name in Config.__annotations__:
+            args['--' + name.replace('_', '-')] = getattr(self, name)
+        return args
+
+
+class Stats:
+    """The counters kept for each proprietary suffix (as
+    args[suffix]) of videos encountered, of conversions done and
+    failed (their number, time taken and sizes) and of conversions
+    served from the cache instead (only their number.)"""
+    __slots__ = ('n_encountered', 'n_converted', 'n_failed', 'n_cached',
+                'time_wasted', 'old_size', 'new_size', 'time_delta')
+
+    def __init__(self):
+        self.n_encountered = self.n_converted = self.n_failed = 0
+        self.n_cached = 0
+        self.old_size = self.new_size = 0
+        self.time_wasted = datetime.timedelta(0)
+        self.time_delta = datetime.timedelta(0)
+
+    def __repr__(self):
+        return 'Stats({})'.format(', '.join(
+                    '{}={!r}'.format(name, getattr(self, name))
+                    for name in self.__slots__))
+
+
+def get_args(argv=None):
     """Sets and returns globals (as a dictionary.)
     
-    Use docopt to collect command line arguments, 
-    and sets up other globals.
-    Causes termination if invalid format is given.
+    Use docopt to collect command line arguments (<argv> if given,
+    otherwise sys.argv[1:],) and sets up other globals (see
+    set_up_args.)
+    Causes termination if they can't be used.
+    """
+    from docopt import docopt  # Only the command line needs it.
+    try:
+        return set_up_args(docopt(__doc__, argv=argv, version=VERSION))
+    except ConfigError as error:
+        print("{} Terminating.".format(error))
+        sys.exit(1)
+
+def set_number(args, option, kind=float, positive=False):
+    """Replaces args[option] with the number (of type <kind>) it
+    specifies.  Raises ConfigError unless that is one no less than
+    0 (more than 0 if <positive>.)"""
+    try:
+        value = kind(args[option])
+    except (TypeError, ValueError):
+        value = -1
+    if value < 0 or (positive and value == 0):
+        raise ConfigError("'{}' must be a {} {}.".format(option,
+                    'positive' if positive else 'non negative',
+                    'integer' if kind is int else 'number'))
+    args[option] = value
+
+def set_up_args(args):
+    """Completes <args> (options as docopt returns them, see also
+    Config.to_args) with the globals the work needs and returns it.
+
+    Raises ConfigError if the options can't be used.
     """
-    args = docopt(__doc__, version=VERSION)
     args['--input'] = (
         os.path.abspath(os.path.expanduser(
                                     args['--input'])))
     args['--logfile'] = (
         os.path.abspath(os.path.expanduser(
                                     args['--logfile'])))
+    args['--state'] = (
+        os.path.abspath(os.path.expanduser(
+                                    args['--state'])))
+    if args['--progress-file']:
+        args['--progress-file'] = (
+            os.path.abspath(os.path.expanduser(
+                                        args['--progress-file'])))
+    args['state'] = None
+    args['logger'] = None
+    if not args['--link-mode'] in LINK_MODES:
+        raise ConfigError("'{}' is an unrecognized link mode."
+                    .format(args['--link-mode']))
+    args['link_stats'] = {}
+    if args['--cache-dir']:
+        args['--cache-dir'] = (
+            os.path.abspath(os.path.expanduser(
+                                        args['--cache-dir'])))
+    set_number(args, '--cache-size')
+    args['cache_stats'] = dict(hits=0, misses=0, bytes_served=0,
+                                evicted=0)
+    if not args['--log-format'] in ('text', 'json'):
+        raise ConfigError("'{}' is an unrecognized log format."
+                    .format(args['--log-format']))
+    if args['--in-place'] and args['--output']:
+        raise ConfigError("--output and --in-place are exclusive.")
     if args['--in-place']:
         args['--output'] = args['--input']
-    else:
+    elif args['--output']:
         args['--output'] = (
             os.path.abspath(os.path.expanduser(
                                         args['--output'])))
+    elif not (args['--list-profiles'] or args['--work']):
+        raise ConfigError("Either --output or --in-place is required.")
     args['html_suffix'] = '.html'
     args['proprietary_suffixes'] = PROPRIETARY_SUFFIXES
     for suffix in args['proprietary_suffixes']:
-        args[suffix] = {}
-        args[suffix]['n_encountered'] = 0
-        args[suffix]['n_converted'] = 0
-        args[suffix]['n_failed'] = 0
-        args[suffix]['time_wasted'] = datetime.timedelta(0, 0, 0)
-        args[suffix]['old_size'] = 0
-        args[suffix]['new_size'] = 0
-        args[suffix]['time_delta'] = datetime.timedelta(0, 0, 0)
+        args[suffix] = Stats()
     args['n_html'] = 0
     args['n_changed'] = 0
-    args['current_proprietary_suffix'] = ''
-    if args['--format'] == 'webm':
-        args['new_suffix'] = '.webm'
-        args['command'] =' '.join(("avconv -flags qscale",
-                            "-global_quality 1 -i '{}' -y '{}'"))
-    elif args['--format'] == 'ogv':
-        args['new_suffix'] = '.ogv'
-        args['command'] =' '.join(("avconv -flags qscale",
-            "-global_quality 1 -i '{}' -acodec libvorbis '{}'"))
-    else:
-        if args['--verbose']:
-            print("'{}' is an unrecognized format. Terminating."
-                        .format(args['--format']))
-        sys.exit(1)
+    args['n_links'] = 0
+    args['phase_times'] = {}
+    args['metrics'] = {}
+    args['progress'] = None
+    args['lock'] = threading.RLock()
+    args['scanned_dirs'] = {}
+    args['probe_stats'] = dict(probed=0, unreadable=0, audio_only=0,
+                                outgrown=0)
+    if args['--max-growth'] is not None:
+        set_number(args, '--max-growth', positive=True)
+    set_number(args, '--min-free')
+    args['growth_history'] = None
+    args['space_stats'] = dict(pauses=0, no_room=0, deleted=0,
+                                bytes_freed=0)
+    args['paused'] = False
+    if args['--delete-originals'] and not args['--in-place']:
+        raise ConfigError("--delete-originals requires --in-place.")
+    args['n_skipped_dirs'] = 0
+    set_number(args, '--lease-timeout', positive=True)
+    if args['--worker-id'] == '<host>-<pid>':
+        args['--worker-id'] = '{}-{}'.format(socket.gethostname(),
+                                            os.getpid())
+    for key in ('--queue', '--work'):
+        if args[key]:
+            args[key] = os.path.abspath(os.path.expanduser(args[key]))
+    if not args['--engine'] in ('pool', 'async'):
+        raise ConfigError("'{}' is an unrecognized engine."
+                    .format(args['--engine']))
+    if args['--queue'] and args['--engine'] != 'pool':
+        raise ConfigError("--queue requires the pool engine.")
+    args['link_pattern'] = compile_link_pattern(
+                                    args['proprietary_suffixes'])
+    args['converted'] = set()
+    args['failed'] = set()
+    args['changed_videos'] = set()
+    args['n_html_skipped'] = 0
+    set_number(args, '--jobs', int, positive=True)
+    if not args['--order'] in ('largest', 'smallest', 'walk'):
+        raise ConfigError("'{}' is an unrecognized order."
+                    .format(args['--order']))
+    set_number(args, '--time-per-meg')
+    set_up_encoder(args)
     if args['--debug']:
         print(args)
     return(args)
 
+def load_profiles(args):
+    """Returns the encoder profiles: ENCODER_PROFILES updated with
+    those found in args['--profiles'] (if specified.)
+    
+    Raises ConfigError if the file can't be used."""
+    profiles = dict(ENCODER_PROFILES)
+    if args['--profiles']:
+        try:
+            with open(os.path.expanduser(args['--profiles'])) as f:
+                added = json.load(f)
+            for name, profile in added.items():
+                for key in ('suffix', 'encoders', 'arguments'):
+                    if not key in profile:
+                        raise ValueError("profile '{}' has no '{}'"
+                                            .format(name, key))
+                profile.setdefault('input_arguments', [])
+                profile.setdefault('presets', {})
+                profile['presets'].setdefault('default', [])
+                profiles[name] = profile
+        except (OSError, ValueError, AttributeError) as error:
+            raise ConfigError("Can't use profiles file '{}': {}."
+                        .format(args['--profiles'], error))
+    return profiles
+
+def installed_encoders(profiles):
+    """Returns a dictionary keyed by the name of every encoder the
+    <profiles> mention, of the full path to each that is installed
+    (None for those that aren't.)"""
+    encoders = {}
+    for profile in profiles.values():
+        for encoder in profile['encoders']:
+            if not encoder in encoders:
+                encoders[encoder] = shutil.which(encoder)
+    return encoders
+
+def encoder_command(args, threads=None, audio_only=False):
+    """Returns the encoder command line (a list) for the chosen
+    profile, preset and encoder with '{input}' and '{output}' for
+    the file names.  '-threads' is included only if <threads>.
+    If <audio_only>, the profile's 'audio_arguments' are used."""
+    profile = args['profile']
+    command = [args['encoder'], '-y']
+    command.extend(profile['input_arguments'])
+    command.extend(['-i', '{input}'])
+    if audio_only:
+        command.extend(profile['audio_arguments'])
+    else:
+        command.extend(profile['arguments'])
+        command.extend(profile['presets'][args['--preset']])
+    if threads:
+        command.extend(['-threads', str(threads)])
+    command.append('{output}')
+    return command
+
+def set_up_encoder(args):
+    """Chooses the encoder profile, preset, program and threads as
+    specified by args and sets args['profile'], args['new_suffix'],
+    args['encoder'], args['threads'], args['command'] (see
+    encoder_command) and args['prober'] (None if there is none.)
+    args['cache_command'] is the same less the thread count which
+    doesn't change the result.  args['audio_command'] and
+    args['audio_cache_command'] are their equivalents for audio
+    only sources (None if the profile has no 'audio_arguments'.)
+    Raises ConfigError if they can't be satisfied.
+    """
+    args['profiles'] = load_profiles(args)
+    args['encoders'] = installed_encoders(args['profiles'])
+    if args['--list-profiles']:
+        return
+    if not args['--format'] in args['profiles']:
+        raise ConfigError("'{}' is an unrecognized format."
+                    .format(args['--format']))
+    args['profile'] = args['profiles'][args['--format']]
+    args['new_suffix'] = args['profile']['suffix']
+    if not args['--preset'] in args['profile']['presets']:
+        raise ConfigError("Format '{}' has no '{}' preset."
+                    .format(args['--format'], args['--preset']))
+    if args['--encoder'] == 'auto':
+        candidates = [encoder for encoder in args['profile']['encoders']
+                        if args['encoders'].get(encoder)]
+        # If none is installed, say so when trying the first one.
+        args['encoder'] = (candidates or args['profile']['encoders'])[0]
+    elif args['--encoder'] in args['profile']['encoders']:
+        args['encoder'] = args['--encoder']
+    else:
+        raise ConfigError("Format '{}' can't be encoded by '{}'."
+                    .format(args['--format'], args['--encoder']))
+    if not (args['encoders'].get(args['encoder']) or args['--dry-run']):
+        raise ConfigError("Encoder '{}' is not installed."
+                    .format(args['encoder']))
+    if args['--threads'] != 'auto':
+        set_number(args, '--threads', int, positive=True)
+        args['threads'] = args['--threads']
+    elif args['profile'].get('threads', 'auto') != 'auto':
+        args['threads'] = int(args['profile']['threads'])
+    else:
+        args['threads'] = max(1, (os.cpu_count() or 1) // args['--jobs'])
+    args['command'] = encoder_command(args, args['threads'])
+    args['cache_command'] = encoder_command(args)
+    if 'audio_arguments' in args['profile']:
+        args['audio_command'] = encoder_command(args, args['threads'],
+                                                audio_only=True)
+        args['audio_cache_command'] = encoder_command(args,
+                                                audio_only=True)
+    else:
+        args['audio_command'] = args['audio_cache_command'] = None
+    if args['--probe'] == 'none':
+        args['prober'] = None
+    elif args['--probe'] == 'auto':
+        candidates = [PROBERS.get(args['encoder'])] + list(PROBERS.values())
+        args['prober'] = next((prober for prober in candidates
+                                if prober and shutil.which(prober)), None)
+    elif shutil.which(args['--probe']) or args['--dry-run']:
+        args['prober'] = args['--probe']
+    else:
+        raise ConfigError("Prober '{}' is not installed."
+                    .format(args['--probe']))
+
+def get_profile_listing(args):
+    """Returns a description of the encoder profiles and presets
+    and of which encoders are installed."""
+    lines = ["Encoder profiles (format: suffix, presets, encoders):"]
+    for name, profile in sorted(args['profiles'].items()):
+        lines.append("    {}: {}, {}, {}".format(name,
+                    profile['suffix'],
+                    '/'.join(sorted(profile['presets'])),
+                    '/'.join(profile['encoders'])))
+    lines.append("Encoders installed:")
+    for encoder, path in sorted(args['encoders'].items()):
+        lines.append("    {}: {}".format(encoder,
+                                        path or 'not found'))
+    return '\n'.join(lines)
+
 
 def debug(entry, args):
     """Provides debugging notices.
@@ -122,155 +628,2284 @@ def report(entry, args):
     if args['--verbose']:
         print(entry)
 
+def format_log_entry(entry, args):
+    """Returns <entry> as it is to appear in the log file."""
+    if args['--log-format'] == 'json':
+        return "{0}\n".format(json.dumps(dict(
+                    time=str(datetime.datetime.now())[:19],
+                    entry=str(entry))))
+    return "{0}\n".format(entry)
+
 def log(entry, args):
     """Provides logging to args['--logfile']
+
+    Entries are buffered by args['logger'] if logging has been
+    started (see start_logging,) otherwise written immediately.
     """
-    with (open(args['--logfile'], "a")) as f:
-        f.write("{0}\n".format(entry))
+    with timed('log', args):
+        if args['logger'] is not None:
+            args['logger'].log(format_log_entry(entry, args))
+        else:
+            with (open(args['--logfile'], "a")) as f:
+                f.write(format_log_entry(entry, args))
 
 def status(entry, args):
     """Provides for a file that contains the last thing attempted.
     
     The file name is args['--statusfile']
-    It is over written with each entry.
-    """
-    with (open(args['--statusfile'], "w")) as f:
-        f.write("{0}\n".format(entry))
-
-def is_target_video_file(file_name, args):
-    """Checks if <file_name> ends in one of the suffixes specified in
-    args['proprietary_suffixes'].  If so, returns True after setting
-    args['current_proprietary_suffix'].  Otherwise it returns False.
-    Clients of this function can decide if they want to reset
-    args['current_proprietary_suffix'] to the empty string.
-    It is suggested that they do.""" 
-    for suffix in args['proprietary_suffixes']:
+    It is over written with each entry (but only as often as
+    args['logger'] flushes, if logging has been started.)
+    """
+    if args['logger'] is not None:
+        args['logger'].status(entry)
+    else:
+        with (open(args['--statusfile'], "w")) as f:
+            f.write("{0}\n".format(entry))
+
+class LogWriter(threading.Thread):
+    """Background thread writing the log and status files.
+
+    Log entries are kept in memory and appended to the log file
+    whenever LOG_FLUSH_BYTES have accumulated or LOG_FLUSH_SECONDS
+    have passed, whichever comes first.  Only the last status entry
+    is kept, to be written at the same time.
+    """
+
+    def __init__(self, logfile, statusfile, args=None):
+        super().__init__(name='LogWriter', daemon=True)
+        self.args = args
+        self.logfile = logfile
+        self.statusfile = statusfile
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.entries = []
+        self.size = 0
+        self.last_status = None
+        self.closing = False
+
+    def log(self, entry):
+        with self.condition:
+            self.entries.append(entry)
+            self.size += len(entry)
+            if self.size >= LOG_FLUSH_BYTES:
+                self.condition.notify()
+
+    def status(self, entry):
+        with self.condition:
+            self.last_status = entry
+
+    def flush(self):
+        """Writes out whatever is buffered."""
+        with self.write_lock, timed('log_io', self.args):
+            with self.condition:
+                entries, self.entries, self.size = self.entries, [], 0
+                last_status, self.last_status = self.last_status, None
+            if entries:
+                with open(self.logfile, "a") as f:
+                    f.write(''.join(entries))
+            if last_status is not None:
+                with open(self.statusfile, "w") as f:
+                    f.write("{0}\n".format(last_status))
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.closing:
+                    self.condition.wait(LOG_FLUSH_SECONDS)
+                closing = self.closing
+            self.flush()
+            if closing:
+                return
+
+    def close(self):
+        """Stops the thread once everything is written."""
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        if self.is_alive():
+            self.join()
+        self.flush()
+
+def start_logging(args, handle_signals=True):
+    """Starts buffered logging (see LogWriter) for log and status.
+
+    Whatever is buffered is guaranteed to be written at exit,
+    including (if <handle_signals>) termination by SIGTERM or SIGHUP.
+    """
+    if args['logger'] is not None:
+        return
+    args['logger'] = LogWriter(args['--logfile'], args['--statusfile'],
+                                args)
+    args['logger'].start()
+    args['at_exit'] = lambda: stop_logging(args)
+    atexit.register(args['at_exit'])
+
+    def terminate(signum, frame):
+        sys.exit(128 + signum)  # Lets atexit (and finally) do its job.
+
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        if (handle_signals
+                and threading.current_thread() is threading.main_thread()):
+            signal.signal(signum, terminate)
+
+def stop_logging(args):
+    """Writes out anything buffered and returns to unbuffered
+    logging."""
+    if args['logger'] is not None:
+        args['logger'].close()
+        args['logger'] = None
+        atexit.unregister(args.pop('at_exit'))
+
+@contextlib.contextmanager
+def timed(phase, args, directory=None):
+    """Context manager recording (see record_time) how long its
+    block takes, if args['--profile'] is set."""
+    if args is None or not args['--profile']:
+        yield
+        return
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_time(phase, time.perf_counter() - begin, args, directory)
+
+def record_time(phase, seconds, args, directory=None):
+    """Adds <seconds> to the timings kept for <phase> in
+    args['metrics'], both overall and for <directory> (if given.)
+
+    args['metrics'] maps each directory ('' for the whole run)
+    to a dictionary of phase: list of timings.
+    """
+    if not args['--profile']:
+        return
+    keys = ('',) if directory is None else ('', directory)
+    for key in keys:
+        args['metrics'].setdefault(key, {}).setdefault(phase,
+                                                [] ).append(seconds)
+
+def scan_tree(top, args):
+    """Walks the directory tree <top> (as would os.walk: top down,
+    not following links to directories) using os.scandir, recording
+    (as 'walk') the time each step takes.
+
+    Generates, for each directory, a (path, entries) tuple, entries
+    being the os.DirEntry objects of its non directory entries: their
+    type and (lstat) information cost no further system calls once
+    known.
+    """
+    stack = [top]
+    while stack:
+        directory = stack.pop()
+        with timed('walk', args, directory):
+            try:
+                with os.scandir(directory) as it:
+                    entries = list(it)
+            except OSError as error:
+                log("Unable to scan {}: {}".format(directory, error),
+                    args)
+                continue
+        files = []
+        sub_directories = []
+        for entry in entries:
+            try:
+                is_directory = entry.is_dir()
+            except OSError:
+                is_directory = False
+            if not is_directory:
+                files.append(entry)
+            elif not entry.is_symlink():
+                sub_directories.append(entry.path)
+        yield directory, files
+        stack.extend(reversed(sub_directories))
+
+def destination_of(source, args):
+    """Returns the path in args['--output'] corresponding to the
+    path <source> in args['--input']."""
+    return args['--output'] + source[len(args['--input']):]
+
+def summarize_timings(timings):
+    """Returns a dictionary of count, total, p50, p95 and max of
+    the list <timings> (in seconds.)"""
+    ordered = sorted(timings)
+
+    def percentile(fraction):
+        return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+    return dict(count=len(ordered), total=sum(ordered),
+                p50=percentile(0.5), p95=percentile(0.95),
+                max=ordered[-1])
+
+def write_profile(args):
+    """Writes a summary of args['metrics'] and args['phase_times']
+    to args['--logfile'] + '.profile.json'.  Returns its name."""
+    metrics = {directory: {phase: summarize_timings(timings)
+                            for phase, timings in list(phases.items())}
+                for directory, phases in list(args['metrics'].items())}
+    profile_file = args['--logfile'] + '.profile.json'
+    with open(profile_file, 'w') as f:
+        json.dump(dict(date=str(datetime.datetime.now())[:19],
+                        phase_times=args['phase_times'],
+                        totals=metrics.pop('', {}),
+                        directories=metrics),
+                    f, indent=1, sort_keys=True)
+    return profile_file
+
+def video_suffix(file_name, suffixes=PROPRIETARY_SUFFIXES):
+    """Returns the one of <suffixes> <file_name> ends in, or None."""
+    for suffix in suffixes:
         if file_name.endswith(suffix):
-            args['current_proprietary_suffix'] = suffix
-            return True
+            return suffix
+
+def classify(file_name, in_place, html_suffix='.html',
+                suffixes=PROPRIETARY_SUFFIXES):
+    """Returns (kind, suffix): what is to be done with <file_name>,
+    kind being 'html', 'video' (suffix being then the one of
+    <suffixes> it ends in,) 'copy' or, if <in_place> and it is
+    neither html nor video, None."""
+    if file_name.endswith(html_suffix):
+        return 'html', None
+    suffix = video_suffix(file_name, suffixes)
+    if suffix:
+        return 'video', suffix
+    return (None if in_place else 'copy'), None
+
+def converted_name(path, suffix, new_suffix):
+    """Returns <path> (which ends in <suffix>) ending in <new_suffix>
+    instead."""
+    return path[:-len(suffix)] + new_suffix
+
+def open_state(args, read_only=False):
+    """Opens (creating it if need be) the state database named by
+    args['--state'] and keeps the connection as args['state'].
+
+    There is one row per source/destination pair attempted.
+    If <read_only>, a missing database is not created and
+    args['state'] is left as None.
+    The connection may be used from any thread holding args['lock'].
+    """
+    if read_only:
+        if not os.path.isfile(args['--state']):
+            return
+        args['state'] = sqlite3.connect(
+                'file:{}?mode=ro'.format(args['--state']), uri=True,
+                check_same_thread=False)
+        return
+    args['state'] = sqlite3.connect(args['--state'],
+                                    check_same_thread=False)
+    args['state'].executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        CREATE TABLE IF NOT EXISTS sources (
+            source TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            suffix TEXT NOT NULL,
+            size INTEGER,
+            mtime INTEGER,
+            fingerprint TEXT,
+            status TEXT,
+            output_size INTEGER,
+            duration REAL,
+            updated TEXT,
+            PRIMARY KEY (source, destination));
+        CREATE TABLE IF NOT EXISTS probes (
+            source TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime INTEGER,
+            result TEXT,
+            updated TEXT);
+        CREATE TABLE IF NOT EXISTS links (
+            html TEXT NOT NULL,
+            video TEXT NOT NULL,
+            PRIMARY KEY (html, video));
+        CREATE INDEX IF NOT EXISTS links_by_video ON links (video);
+        CREATE TABLE IF NOT EXISTS pages (
+            html TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            new_suffix TEXT NOT NULL,
+            mtime INTEGER,
+            updated TEXT,
+            PRIMARY KEY (html, destination, new_suffix));
+        CREATE TABLE IF NOT EXISTS directories (
+            source TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            new_suffix TEXT NOT NULL,
+            mtime INTEGER,
+            updated TEXT,
+            PRIMARY KEY (source, destination, new_suffix));
+        """)
+
+def close_state(args):
+    """Closes the state database, committing what is pending (see
+    record_page,) if it is open."""
+    if args['state'] is not None:
+        with args['lock']:
+            args['state'].commit()
+        args['state'].close()
+        args['state'] = None
+
+def fingerprint(path):
+    """Returns a content fingerprint of the file at <path>: a hash of
+    all of it (an edit anywhere in a source must change it, lest a
+    stale conversion be kept or served from the cache.)"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_state(source, destination, args):
+    """Returns the state database row (as a dictionary) recorded
+    for converting <source> to <destination>, or None."""
+    if args['state'] is None:
+        return
+    with args['lock']:
+        row = args['state'].execute(
+            """SELECT size, mtime, fingerprint, status, output_size
+                FROM sources WHERE source = ? AND destination = ?""",
+            (source, destination)).fetchone()
+    if row:
+        return dict(zip(('size', 'mtime', 'fingerprint',
+                        'status', 'output_size'), row))
+
+def set_state(item, status, args,
+                output_size=None, duration=None, source_fingerprint=None):
+    """Records <status> ('encoding', 'done' or 'failed') for the
+    manifest video entry <item> in the state database."""
+    if args['state'] is None:
+        return
+    info = os.stat(item['source'])
+    with args['lock']:
+        args['state'].execute(
+            """INSERT OR REPLACE INTO sources VALUES
+                (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (item['source'], item['destination'], item['suffix'],
+            info.st_size, info.st_mtime_ns, source_fingerprint, status,
+            output_size, duration, str(datetime.datetime.now())[:19]))
+        args['state'].commit()
+
+def is_done(item, args):
+    """Returns True if the state database shows that the manifest
+    video entry <item> has been completely converted, the source
+    hasn't changed since and the conversion is still in place.
+
+    A source whose size or mtime have changed is fingerprinted: if
+    only its mtime changed the record is brought up to date,
+    otherwise it will be converted again.
+    """
+    row = get_state(item['source'], item['destination'], args)
+    if row is None or row['status'] != 'done':
+        return False
+    try:
+        if os.stat(item['destination']).st_size != row['output_size']:
+            return False
+    except FileNotFoundError:
+        return False
+    info = os.stat(item['source'])
+    if (info.st_size, info.st_mtime_ns) == (row['size'], row['mtime']):
+        return True
+    if (info.st_size == row['size'] and not args['--dry-run']
+            and fingerprint(item['source']) == row['fingerprint']):
+        with args['lock']:
+            args['state'].execute(
+                """UPDATE sources SET mtime = ?
+                    WHERE source = ? AND destination = ?""",
+                (info.st_mtime_ns, item['source'], item['destination']))
+            args['state'].commit()
+        return True
     return False
 
-def convert_video(source, destination, args):
-    """Convert to alternate video format.
-    
-    Format of source is assumed to be one of the ones listed
-    in args['proprietary_suffixes'].
-    Format of destination is determined by args['--format'].
-    Return code 0 (success) or 1.
-    Side effect: logs problems if they occur.
-    This depends on the log function.
+def is_unchanged_directory(source_dir, dest_dir, args):
+    """Returns True if the state database shows that every file of
+    <source_dir> was dealt with (see record_directories) and its
+    mtime hasn't changed since, i.e. no file has been added to it,
+    removed or renamed.
+
+    A file modified in place doesn't change the mtime of its
+    directory: only use --skip-unchanged where files are replaced
+    rather than edited.
     """
-    
-    command_line = shlex.split(args['command']
-                            .format(source, destination))
+    if args['state'] is None:
+        return False
+    with args['lock']:
+        row = args['state'].execute(
+            """SELECT mtime FROM directories
+                WHERE source = ? AND destination = ? AND new_suffix = ?""",
+            (source_dir, dest_dir, args['new_suffix'])).fetchone()
+    if row is None:
+        return False
+    try:
+        return os.stat(source_dir).st_mtime_ns == row[0]
+    except FileNotFoundError:
+        return False
+
+def record_directories(args):
+    """Records in the state database, once the work is done, the
+    mtime of each directory scanned (see scan_items) all of whose
+    videos have been converted, so that a later run with
+    --skip-unchanged can skip its files.  Other directories are
+    forgotten.
+
+    The mtime is taken now since working in place changes it.
+    """
+    if args['state'] is None:
+        return
+    now = str(datetime.datetime.now())[:19]
+    with args['lock']:
+        for (source_dir, dest_dir), videos in args['scanned_dirs'].items():
+            complete = all(
+                (get_state(item['source'], item['destination'], args)
+                    or {}).get('status') == 'done'
+                for item in videos)
+            key = (source_dir, dest_dir, args['new_suffix'])
+            if complete and os.path.isdir(source_dir):
+                args['state'].execute(
+                    """INSERT OR REPLACE INTO directories
+                        VALUES (?, ?, ?, ?, ?)""",
+                    key + (os.stat(source_dir).st_mtime_ns, now))
+            else:
+                args['state'].execute(
+                    """DELETE FROM directories WHERE source = ?
+                        AND destination = ? AND new_suffix = ?""", key)
+        args['state'].commit()
+
+def partial_name(destination):
+    """Returns the temporary name under which <destination> is
+    written by the encoder.  The suffix is kept since the encoder
+    relies on it to choose the format."""
+    head, tail = os.path.split(destination)
+    return os.path.join(head, PARTIAL_PREFIX + tail)
+
+def get_history(args):
+    """Returns Stats (as are args[suffix]) for every
+    conversion recorded in the state database, keyed by suffix.
+    Conversions served from the cache are those recorded as done
+    without a duration."""
+    history = {}
+    for suffix in args['proprietary_suffixes']:
+        history[suffix] = Stats()
+    if args['state'] is None:
+        return history
+    with args['lock']:
+        rows = args['state'].execute(
+                """SELECT suffix, status, duration IS NULL, COUNT(*),
+                        SUM(size), SUM(output_size), SUM(duration)
+                    FROM sources GROUP BY suffix, status,
+                        duration IS NULL""").fetchall()
+    for (suffix, status, cached, number,
+            size, output_size, duration) in rows:
+        if not suffix in history:
+            continue
+        counters = history[suffix]
+        counters.n_encountered += number
+        if status == 'done' and cached:
+            counters.n_cached += number
+        elif status == 'done':
+            counters.n_converted += number
+            counters.old_size += size or 0
+            counters.new_size += output_size or 0
+            counters.time_delta += datetime.timedelta(
+                                            seconds=duration or 0)
+        elif status == 'failed':
+            counters.n_failed += number
+            counters.time_wasted += datetime.timedelta(
+                                            seconds=duration or 0)
+    return history
+
+def start_progress(manifest, args):
+    """Sets up args['progress'] to follow the execution of
+    <manifest>: total and completed files, and total and completed
+    bytes of source video still to be converted.
+    (Items can be added later- see add_to_progress.)"""
+    args['progress'] = dict(start=time.time(),
+                            files_total=0,
+                            files_done=0,
+                            videos_total=0,
+                            videos_done=0,
+                            bytes_total=0,
+                            bytes_done=0,
+                            completions=collections.deque(),
+                            shown=0.0,
+                            saved=0.0)
+    for item in manifest['files']:
+        add_to_progress(item, args)
+
+def add_to_progress(item, args):
+    """Adds the manifest entry <item> to the work args['progress']
+    follows."""
+    progress = args['progress']
+    with args['lock']:
+        progress['files_total'] += 1
+        if item['kind'] == 'video' and not item['exists']:
+            progress['videos_total'] += 1
+            progress['bytes_total'] += item['size']
+
+def advance_progress(args, video_bytes=None):
+    """Counts one more file of the manifest done; <video_bytes>
+    being the size of the source if it was a video conversion
+    (successful or not.)"""
+    progress = args['progress']
+    if progress is None:
+        return
+    with args['lock']:
+        progress['files_done'] += 1
+        if video_bytes is not None:
+            progress['videos_done'] += 1
+            progress['bytes_done'] += video_bytes
+            progress['completions'].append((time.time(), video_bytes))
+        show_progress(args)
+
+def get_progress(args):
+    """Returns a snapshot (a dictionary) of args['progress'].
+
+    The rate is in megs of source per minute, taken over the last
+    PROGRESS_WINDOW seconds; the ETA is what remains at that rate.
+    """
+    progress = args['progress']
+    now = time.time()
+    completions = progress['completions']
+    while completions and completions[0][0] < now - PROGRESS_WINDOW:
+        completions.popleft()
+    window = now - max(progress['start'], now - PROGRESS_WINDOW)
+    if completions and window > 0:
+        rate = sum(size for _, size in completions) / 1000000 / (
+                                                        window / 60)
+    else:
+        rate = 0.0
+    remaining = progress['bytes_total'] - progress['bytes_done']
+    if rate:
+        eta = str(datetime.timedelta(
+                    seconds=int(remaining / 1000000 / rate * 60)))
+    else:
+        eta = None
+    return dict(time=str(datetime.datetime.now())[:19],
+                elapsed=str(datetime.timedelta(
+                            seconds=int(now - progress['start']))),
+                files_done=progress['files_done'],
+                files_remaining=(progress['files_total']
+                                    - progress['files_done']),
+                videos_done=progress['videos_done'],
+                videos_remaining=(progress['videos_total']
+                                    - progress['videos_done']),
+                video_bytes_done=progress['bytes_done'],
+                video_bytes_remaining=remaining,
+                megs_per_minute=round(rate, 2),
+                eta=eta)
+
+def show_progress(args, final=False):
+    """Shows progress on stderr (if args['--progress'], at most every
+    PROGRESS_INTERVAL seconds) and writes it to
+    args['--progress-file'] (at most every PROGRESS_SNAPSHOT_SECONDS,)
+    unless <final> which forces both."""
+    progress = args['progress']
+    if progress is None or not (args['--progress']
+                                or args['--progress-file']):
+        return
+    now = time.time()
+    if args['--progress'] and (final
+                    or now - progress['shown'] >= PROGRESS_INTERVAL):
+        progress['shown'] = now
+        snapshot = get_progress(args)
+        sys.stderr.write(
+            "\rfiles {}/{}, videos {}/{} ({:,.1f}/{:,.1f} MB), "
+            "{:.1f} MB/min, ETA {}   ".format(
+                snapshot['files_done'], progress['files_total'],
+                snapshot['videos_done'], progress['videos_total'],
+                snapshot['video_bytes_done'] / 1000000,
+                progress['bytes_total'] / 1000000,
+                snapshot['megs_per_minute'], snapshot['eta'] or '?'))
+        if final:
+            sys.stderr.write("\n")
+        sys.stderr.flush()
+    if args['--progress-file'] and (final
+            or now - progress['saved'] >= PROGRESS_SNAPSHOT_SECONDS):
+        progress['saved'] = now
+        temporary = partial_name(args['--progress-file'])
+        with open(temporary, 'w') as f:
+            json.dump(get_progress(args), f, indent=1)
+        os.replace(temporary, args['--progress-file'])
+
+def fill_command(command, source, destination):
+    """Returns the encoder <command> (see encoder_command) converting
+    <source> to <destination>."""
+    return [part.replace('{input}', source)
+                .replace('{output}', destination)
+            for part in command]
+
+def get_command_line(source, destination, args, audio_only=False):
+    """Returns the encoder command line (a list) converting <source>
+    (<audio_only> if the probe found no video in it) to
+    <destination>."""
+    command_line = fill_command(
+                args['audio_command'] if audio_only else args['command'],
+                source, destination)
     debug("""Command line being called is:
     {}""".format(" ".join(command_line)),
         args)
-    return_code = subprocess.call(command_line)
+    return command_line
+
+def start_conversion(source, destination, args, audio_only=False):
+    """Launch the encoder as a background process.
+
+    Format of source is assumed to be one of the ones listed
+    in args['proprietary_suffixes'].
+    Format of destination is determined by args['--format'].
+    Returns the subprocess.Popen instance without waiting for it.
+    """
+    command_line = get_command_line(source, destination, args,
+                                    audio_only)
+    with timed('encoder_spawn', args, os.path.dirname(source)):
+        return subprocess.Popen(command_line)
+
+def check_conversion(source, destination, return_code, args):
+    """Deal with the aftermath of a conversion.
+
+    Logs problems if they occur (depends on the log function)
+    otherwise copies the mode of source over to destination.
+    Returns return_code.
+    """
     if return_code:
-        message = ("{:24}: {} => return code >0."
-                    .format(datetime.datetime.now(), source))
+        message = ("{:24}: {} => return code {}."
+                    .format(datetime.datetime.now(), source, return_code))
         log(message, args)
         report(message, args)
     else:
-        # The subprocess.call has already moved the data,
+        # The encoder has already moved the data,
         # here we just want to move the metadata.
         shutil.copymode(source, destination, follow_symlinks=False)
     return return_code
 
-def convert_text(text, old, new):
-    """Text replacement.
+def cache_key(source_fingerprint, args, audio_only=False):
+    """Returns the key under which the conversion of a source is
+    kept in the cache: a hash of <source_fingerprint> and of
+    the encoder command (so a change of format or of encoder
+    options never returns a stale conversion.)"""
+    command = (args['audio_cache_command'] if audio_only
+                else args['cache_command'])
+    digest = hashlib.sha1()
+    for part in (source_fingerprint, ' '.join(command),
+                    args['new_suffix']):
+        digest.update(part.encode())
+    return digest.hexdigest()
+
+def cache_path(key, args):
+    """Returns where in args['--cache-dir'] <key> is kept."""
+    return os.path.join(args['--cache-dir'], key[:2],
+                        key + args['new_suffix'])
+
+def link_or_clone(source, destination):
+    """Hard links <source> to <destination> if possible, otherwise
+    copies it (see clone_file.)"""
+    try:
+        os.link(source, destination)
+    except OSError:
+        clone_file(source, destination)
+
+def fetch_cached(job, args):
+    """Puts the cached conversion of job['source'], if there is one,
+    at job['partial'].  Returns True if it did.
+
+    It is hard linked there unless its mode differs from the
+    source's (check_conversion gives the conversion the source's
+    mode, which would change the cache entry and every conversion
+    linked to it) in which case it is copied.
+    The cache entry's ctime (rather than its mtime, which it shares
+    with those conversions) is brought up to date since eviction
+    goes by least recent use.
+    """
+    cached = cache_path(job['cache_key'], args)
+    if not os.path.isfile(cached):
+        with args['lock']:
+            args['cache_stats']['misses'] += 1
+        return False
+    info = os.stat(cached)
+    mode = stat.S_IMODE(info.st_mode)
+    if mode == stat.S_IMODE(os.stat(job['source']).st_mode):
+        link_or_clone(cached, job['partial'])
+    else:
+        clone_file(cached, job['partial'])
+    os.chmod(cached, mode)  # Only sets its ctime.
+    size = info.st_size
+    with args['lock']:
+        args['cache_stats']['hits'] += 1
+        args['cache_stats']['bytes_served'] += size
+    return True
+
+def store_cached(job, args):
+    """Adds the conversion at job['destination'] to the cache, then
+    removes least recently used entries until the cache is no
+    bigger than args['--cache-size'] megs."""
+    cached = cache_path(job['cache_key'], args)
+    os.makedirs(os.path.dirname(cached), exist_ok=True)
+    temporary = partial_name(cached)
+    if os.path.lexists(temporary):
+        os.remove(temporary)
+    link_or_clone(job['destination'], temporary)
+    os.replace(temporary, cached)
+    entries = []
+    for directory in os.scandir(args['--cache-dir']):
+        if directory.is_dir(follow_symlinks=False):
+            for entry in os.scandir(directory.path):
+                if entry.is_file(follow_symlinks=False):
+                    info = entry.stat()
+                    entries.append((info.st_ctime, info.st_size,
+                                    entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= args['--cache-size'] * 1000000:
+            break
+        if path == cached:
+            continue
+        os.remove(path)
+        total -= size
+        with args['lock']:
+            args['cache_stats']['evicted'] += 1
+
+def record_conversion(job, return_code, args):
+    """Updates the counters in args[job['suffix']], the log and the
+    state database once the conversion described by <job> has
+    finished.
+
+    <job> is a video entry of the manifest (see plan_work) which
+    the encoder (or fetch_cached) has written to job['partial'].
+    On success that is renamed to job['destination'] (and, if it
+    came from the encoder, added to the cache,) otherwise it is
+    removed, as it is if args['--max-growth'] is exceeded, and (in
+    OUT_DIR, unless it failed for lack of room) the original is
+    placed there instead.
+    A conversion served from the cache is only counted as such (its
+    time and sizes would distort the encoder's figures.)
+    With args['--delete-originals'], a successfully converted source
+    is then deleted.
+    """
+    if not return_code and has_outgrown(job, args):
+        return_code = GROWTH_FAILURE
+    if return_code == GROWTH_FAILURE:
+        with args['lock']:
+            args['probe_stats']['outgrown'] += 1
+    check_conversion(job['source'], job['partial'],
+                        return_code, args)
+    advance_progress(args, video_bytes=job['size'])
+    counters = args[job['suffix']]
+    conversion_time = datetime.datetime.now() - job['begin']
+    if not job.get('cached'):
+        record_time('encoder_runtime', conversion_time.total_seconds(),
+                    args, os.path.dirname(job['source']))
+    if return_code:
+        message = ("FAILED ({}) {}"
+                    .format(return_code, job['source']))
+        print(message)
+        log(message, args)
+        with args['lock']:
+            counters.time_wasted += conversion_time
+            counters.n_failed += 1
+        if os.path.lexists(job['partial']):
+            os.remove(job['partial'])
+        set_state(job, 'failed', args,
+                    duration=conversion_time.total_seconds())
+        update_link_index(job['source'], False, args)
+        if not args['--in-place']:  # Copy unconverted file:
+            if return_code == SPACE_FAILURE:  # No room for it either.
+                log("Not copied for lack of room: {}"
+                        .format(job['source']), args)
+            elif not os.path.isfile(job['dest_if_fail']):
+                place_file(job['source'], job['dest_if_fail'], args)
+    else:
+        os.replace(job['partial'], job['destination'])
+        if job.get('cache_key') and not job.get('cached'):
+            store_cached(job, args)
+        log("{}: {} => {}{}"
+                .format(str(datetime.datetime.now())[:19],
+                        job['file_name'],
+                        args['--format'],
+                        ' (cached)' if job.get('cached') else ''),
+            args)
+        new_size = os.stat(job['destination']).st_size
+        old_size = os.stat(job['source']).st_size
+        with args['lock']:
+            if job.get('cached'):
+                counters.n_cached += 1
+            else:
+                counters.n_converted += 1
+                counters.time_delta += conversion_time
+                counters.old_size += old_size
+                counters.new_size += new_size
+        # No duration marks a conversion from the cache (see get_history.)
+        set_state(job, 'done', args, output_size=new_size,
+                    duration=(None if job.get('cached')
+                                else conversion_time.total_seconds()),
+                    source_fingerprint=job['fingerprint'])
+        update_link_index(job['source'], True, args)
+        if args['--delete-originals']:
+            delete_original(job, args)
+
+def probe(source, args):
+    """Returns what args['prober'] makes of <source>: a dictionary
+    with keys 'readable', 'video' and 'audio' (lists of the codecs of
+    its video and audio streams,) 'duration' (seconds) and 'bit_rate'
+    (None where unknown.)
+
+    Results the prober produced are kept in the state database and
+    reused for as long as the source's size and mtime are unchanged;
+    a failed run of the prober (an error or a time out) is not, lest
+    a transient failure fail the video on every run.
+    """
+    info = os.stat(source)
+    if args['state'] is not None:
+        with args['lock']:
+            row = args['state'].execute(
+                """SELECT size, mtime, result FROM probes
+                    WHERE source = ?""", (source,)).fetchone()
+        if row and tuple(row[:2]) == (info.st_size, info.st_mtime_ns):
+            return json.loads(row[2])
+    result = dict(readable=False, video=[], audio=[],
+                    duration=None, bit_rate=None)
+    with timed('probe', args, os.path.dirname(source)):
+        try:
+            completed = subprocess.run(
+                [args['prober'], '-v', 'error', '-show_format',
+                    '-show_streams', '-of', 'json', source],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                timeout=PROBE_TIMEOUT)
+            found = (json.loads(completed.stdout.decode(errors='replace'))
+                        if completed.returncode == 0 else None)
+        except (subprocess.TimeoutExpired, ValueError):
+            found = None
+    for stream in (found or {}).get('streams', []):
+        if stream.get('codec_type') in ('video', 'audio'):
+            result[stream['codec_type']].append(
+                                    stream.get('codec_name', '?'))
+    for key, kind in (('duration', float), ('bit_rate', int)):
+        with contextlib.suppress(KeyError, TypeError, ValueError):
+            result[key] = kind(found['format'][key])
+    result['readable'] = bool(result['video'] or result['audio'])
+    debug("Probed {}: {}".format(source, result), args)
+    if args['state'] is not None and isinstance(found, dict):
+        with args['lock']:
+            args['state'].execute(
+                "INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?)",
+                (source, info.st_size, info.st_mtime_ns,
+                    json.dumps(result), str(datetime.datetime.now())[:19]))
+            args['state'].commit()
+    return result
+
+def has_outgrown(job, args):
+    """Returns True if the output of the conversion <job> is larger
+    than args['--max-growth'] times its source."""
+    if args['--max-growth'] is None:
+        return False
+    try:
+        size = os.stat(job['partial']).st_size
+    except FileNotFoundError:
+        return False
+    return size > args['--max-growth'] * job['size']
+
+def growth_ratio(suffix, args):
+    """Returns the ratio of output to source size to be expected of
+    converting a <suffix> file: that of the conversions done so far
+    in this run or, failing any, of those recorded in the state
+    database, or DEFAULT_GROWTH.  Never more than args['--max-growth']
+    allows."""
+    counters = args[suffix]
+    if not counters.old_size:
+        if args['growth_history'] is None:
+            args['growth_history'] = get_history(args)
+        counters = args['growth_history'][suffix]
+    if counters.old_size:
+        ratio = counters.new_size / counters.old_size
+    else:
+        ratio = DEFAULT_GROWTH
+    if args['--max-growth'] is not None:
+        ratio = min(ratio, args['--max-growth'])
+    return ratio
+
+def estimate_output(job, args):
+    """Returns the expected size of the conversion of <job>."""
+    return int(job['size'] * growth_ratio(job['suffix'], args))
+
+def get_budget(running, args):
+    """Returns the number of bytes a conversion may yet use on the
+    device args['--output'] is on: the space free less what each of
+    the <running> conversions is expected to add to its output and
+    less args['--min-free'] megs."""
+    info = os.statvfs(args['--output'])
+    budget = (info.f_bavail * info.f_frsize
+                - args['--min-free'] * 1000000)
+    for job in running:
+        try:
+            written = os.stat(job['partial']).st_size
+        except FileNotFoundError:
+            written = 0
+        budget -= max(0, estimate_output(job, args) - written)
+    return budget
+
+def note_pause(paused, args):
+    """Logs the start and end of waits for space."""
+    if paused and not args['paused']:
+        args['space_stats']['pauses'] += 1
+        log("Short of space on {}: waiting for conversions to finish."
+                .format(args['--output']), args)
+    elif args['paused'] and not paused:
+        log("Resuming conversions.", args)
+    args['paused'] = paused
 
-    First and third parameters are strings. 
-    The second (middle) parameter is an iterable of strings.
-    Any occurrence of any of the strings in the the second parameter
-    found in the first parameter is replaced by the third parameter.
-    Returns altered text or None if no alterations were done.
+def admit_job(pool, args):
+    """Takes from pool['pending'] and returns the first job there is
+    room for (see get_budget,) so that, when space is short, smaller
+    videos go ahead of larger ones.
+
+    Returns None if none can start before a running one finishes.
+    If none can and none is running (so no more room is to be
+    expected) the first is returned with job['no_room'] set.
+    """
+    budget = get_budget(pool['running'], args)
+    for job in pool['pending']:
+        if estimate_output(job, args) <= budget:
+            pool['pending'].remove(job)
+            note_pause(False, args)
+            return job
+    if pool['running']:
+        note_pause(True, args)
+        return
+    job = pool['pending'].popleft()
+    job['no_room'] = True
+    return job
+
+def delete_original(job, args):
+    """Deletes the source of the (successful) conversion <job>."""
+    size = os.stat(job['source'], follow_symlinks=False).st_size
+    os.remove(job['source'])
+    with args['lock']:
+        args['space_stats']['deleted'] += 1
+        args['space_stats']['bytes_freed'] += size
+    log("Deleted original {}".format(job['source']), args)
+
+def prepare_job(job, args):
+    """Gets the manifest video entry <job> ready for conversion:
+    sets job['partial'] (removing any left there by a crash,)
+    job['begin'], job['fingerprint'] (only computed once, however
+    often the job is prepared, since it reads all of the source)
+    and, if args['--cache-dir'], job['cache_key'].
+
+    If there is a prober, job['probe'] and job['audio_only'] are set
+    too (see probe) and a source it can't read is recorded as a
+    failed conversion (see record_conversion) straight away.
+    Returns False in that case, True if the job is to go ahead.
+    """
+    job['partial'] = partial_name(job['destination'])
+    if os.path.lexists(job['partial']):  # Left by a crash.
+        os.remove(job['partial'])
+    job['begin'] = datetime.datetime.now()
+    status("Converting {}".format(job['source']), args)
+    if args['prober']:
+        job['probe'] = probe(job['source'], args)
+        with args['lock']:
+            args['probe_stats']['probed'] += 1
+        if not job['probe']['readable']:
+            with args['lock']:
+                args['probe_stats']['unreadable'] += 1
+            record_conversion(job, PROBE_FAILURE, args)
+            return False
+        job['audio_only'] = (not job['probe']['video']
+                                and args['audio_command'] is not None)
+        if job['audio_only']:
+            with args['lock']:
+                args['probe_stats']['audio_only'] += 1
+    if not 'fingerprint' in job:
+        job['fingerprint'] = fingerprint(job['source'])
+    if args['--cache-dir']:
+        job['cache_key'] = cache_key(job['fingerprint'], args,
+                                        job.get('audio_only'))
+    return True
+
+def satisfy_from_cache(job, args):
+    """Returns True (having recorded the conversion) if the cache
+    had a conversion for <job>, False if the encoder must run."""
+    job['cached'] = fetch_cached(job, args)
+    if job['cached']:
+        record_conversion(job, 0, args)
+    return job['cached']
+
+def service_conversions(pool, args, wait=False):
+    """Keeps the pool of background conversions going.
+
+    <pool> is a dictionary with a 'pending' deque of jobs waiting
+    to be started and a 'running' list of jobs already started.
+    Finished jobs are recorded (see record_conversion) and pending
+    jobs are started as long as fewer than args['--jobs'] are
+    running.  If <wait> is True, only returns once every job,
+    pending or running, has finished.
+    If args['--cache-dir'] is set, jobs the cache can satisfy are
+    not given to the encoder, and a job whose source is identical
+    to that of a running job waits, in pool['waiting'], for it.
+    Jobs are only started if there is room for them (see admit_job.)
     """
-    ret = 0
-    for target in old:
-        if text.find(target) >= 0:
-            text = text.replace(target[1:], new[1:])
-            ret += 1
-    if ret:
-        return text
+    while True:
+        for job in list(pool['running']):
+            return_code = job['process'].poll()
+            if return_code is None and has_outgrown(job, args):
+                job['process'].kill()
+                job['process'].wait()
+                return_code = GROWTH_FAILURE
+            if return_code is not None:
+                pool['running'].remove(job)
+                record_conversion(job, return_code, args)
+                if job.get('cache_key'):
+                    pool['pending'].extendleft(reversed(
+                            pool['waiting'].pop(job['cache_key'], [])))
+        while (pool['pending']
+                and len(pool['running']) < args['--jobs']):
+            job = admit_job(pool, args)
+            if job is None:
+                break
+            if not prepare_job(job, args):
+                continue
+            if job.get('cache_key'):
+                if any(running.get('cache_key') == job['cache_key']
+                                for running in pool['running']):
+                    pool['waiting'].setdefault(job['cache_key'],
+                                                []).append(job)
+                    continue
+                if satisfy_from_cache(job, args):
+                    continue
+            if job.get('no_room'):
+                args['space_stats']['no_room'] += 1
+                record_conversion(job, SPACE_FAILURE, args)
+                continue
+            set_state(job, 'encoding', args)
+            job['process'] = start_conversion(job['source'],
+                                        job['partial'], args,
+                                        job.get('audio_only'))
+            pool['running'].append(job)
+        show_progress(args)
+        if not (wait and pool['running']):
+            return
+        time.sleep(POLL_INTERVAL)
+
+def compile_link_pattern(suffixes):
+    """Returns a compiled (bytes) regular expression matching src and
+    href attribute values that end in one of <suffixes>.
+
+    Attribute names are matched whatever their case but only as a
+    whole (data-src isn't src.)  A double or single quoted value may
+    contain anything but its own quote, '<' and '>'; an unquoted one
+    neither quotes nor white space.
+    The groups are 'attribute' (the attribute name, '=' and any
+    white space,) 'quote' (may be empty,) 'target' (the reference
+    less its suffix,) 'suffix' and 'query' (any query string or
+    fragment, may be empty.)
+    A match never includes a '>' which find_link_edits relies on.
+    """
+    return re.compile(br"""
+        (?P<attribute>(?<=[\s"'/])(?i:src|href)\s*=\s*)
+        (?P<quote>(?P<double>")|(?P<single>')|)
+        (?P<target>(?:(?(double)[^"<>]|(?(single)[^'<>]|[^"'\s<>])))+?)
+        (?P<suffix>""" + b'|'.join(re.escape(suffix.encode())
+                                    for suffix in suffixes) + br""")
+        (?P<query>[?\#](?:(?(double)[^"<>]|(?(single)[^'<>]|[^"'\s<>])))*)?
+        (?P=quote)
+        (?=[\s/>]|$)""",
+        re.VERBOSE)
 
-def modify_html(source, destination, args):
+def resolve_link(target, html_file, args):
+    """Returns the absolute path of the file <target> (a link, as
+    bytes, found in <html_file>) refers to, or None if it isn't a
+    local file.
+
+    Links beginning with '/' are taken relative to args['--input'].
+    """
+    if b':' in target.split(b'/')[0]:  # http:, data:, mailto: etc
+        return
+    target = os.fsdecode(urllib.parse.unquote_to_bytes(target))
+    if target.startswith('/'):
+        return os.path.normpath(
+                    os.path.join(args['--input'], target.lstrip('/')))
+    return os.path.normpath(
+                os.path.join(os.path.dirname(html_file), target))
+
+def load_link_index(args):
+    """Fills the link index, args['converted'] and args['failed']
+    (sets of the source paths of videos whose conversion succeeded
+    or failed,) from the state database.  Only conversions to
+    args['new_suffix'] in args['--output'] count."""
+    if args['state'] is None:
+        return
+    with args['lock']:
+        rows = args['state'].execute(
+            "SELECT source, destination, suffix, status FROM sources"
+            ).fetchall()
+    for source, destination, suffix, status in rows:
+        if destination != destination_of(
+                converted_name(source, suffix, args['new_suffix']), args):
+            continue
+        if status == 'done':
+            args['converted'].add(source)
+        elif status == 'failed':
+            args['failed'].add(source)
+
+def update_link_index(source, converted, args):
+    """Records in the link index whether the conversion of <source>
+    succeeded (<converted>) or failed, noting in
+    args['changed_videos'] the sources for which that changes
+    whether links to them are to be rewritten."""
+    with args['lock']:
+        was_converted = source in args['converted']
+        if converted:
+            args['converted'].add(source)
+            args['failed'].discard(source)
+        else:
+            args['failed'].add(source)
+            args['converted'].discard(source)
+        if was_converted != converted:
+            args['changed_videos'].add(source)
+
+def record_page(item, references, args):
+    """Records in the state database the videos (<references>, a set
+    of source paths) the manifest html entry <item> refers to, and
+    its mtime now that it has been dealt with.  Committed by
+    close_state."""
+    if args['state'] is None:
+        return
+    mtime = os.stat(item['source']).st_mtime_ns
+    with args['lock']:
+        args['state'].execute("DELETE FROM links WHERE html = ?",
+                                (item['source'],))
+        args['state'].executemany("INSERT INTO links VALUES (?, ?)",
+                        [(item['source'], video) for video in references])
+        args['state'].execute(
+            "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+            (item['source'], item['destination'], args['new_suffix'],
+                mtime, str(datetime.datetime.now())[:19]))
+
+def select_pages(html_items, args):
+    """Returns the manifest html entries to be dealt with once the
+    videos are done: <html_items> or, with args['--incremental-html'],
+    only those of the pages that are new, have changed since they
+    were last dealt with (see record_page) or refer to a video in
+    args['changed_videos'].
+
+    The latter are marked 'refresh' (see modify_html) and added even
+    if they weren't scanned (see --skip-unchanged.)  Pages left out
+    are counted in args['n_html_skipped'].
+    """
+    if not args['--incremental-html'] or args['state'] is None:
+        return html_items
+    stale = set()
+    with args['lock']:
+        for video in args['changed_videos']:
+            stale.update(html for html, in args['state'].execute(
+                    "SELECT html FROM links WHERE video = ?", (video,)))
+        known = dict(((html, destination), mtime)
+                for html, destination, mtime in args['state'].execute(
+                    """SELECT html, destination, mtime FROM pages
+                        WHERE new_suffix = ?""", (args['new_suffix'],)))
+    selected = []
+    for item in html_items:
+        if item['source'] in stale:
+            item['refresh'] = True
+            stale.discard(item['source'])
+        elif (item['exists'] and known.get((item['source'],
+                    item['destination'])) == item['mtime']):
+            args['n_html_skipped'] += 1
+            advance_progress(args)
+            continue
+        selected.append(item)
+    for html in sorted(stale):
+        if not (html.startswith(args['--input'] + os.sep)
+                and os.path.isfile(html)):
+            continue
+        destination = destination_of(html, args)
+        item = dict(kind='html', file_name=os.path.basename(html),
+                    source=html, destination=destination,
+                    size=os.stat(html).st_size,
+                    exists=os.path.lexists(destination), refresh=True)
+        add_to_progress(item, args)
+        selected.append(item)
+    return selected
+
+def is_converted(video, suffix, args):
+    """Returns True if the video file <video> (an absolute path in
+    the source tree ending in <suffix>) has been converted: as the
+    link index (see load_link_index) has it or, for videos it
+    doesn't know, if the conversion is there."""
+    if video in args['converted']:
+        return True
+    if video in args['failed']:
+        return False
+    converted = destination_of(
+                    converted_name(video, suffix, args['new_suffix']), args)
+    return os.path.isfile(converted)
+
+def link_edits(data, endpos, offset, html_file, args, references=None):
+    """Generates the edits needed to data[:endpos].
+
+    <data> is any bytes-like object (including an mmap) holding part
+    of <html_file> starting at <offset> in the file.
+    Only the values of src and href attributes referring to a video
+    that is_converted are changed (their suffix becomes
+    args['new_suffix'].)
+    Yields (start, end, replacement) tuples, start and end being
+    offsets within the file.
+    Every local video referred to is added to the set <references>
+    (if given.)
+    """
+    new_suffix = args['new_suffix'].encode()
+    for match in args['link_pattern'].finditer(data, 0, endpos):
+        suffix = match.group('suffix')
+        video = resolve_link(match.group('target') + suffix,
+                            html_file, args)
+        if video is None:
+            continue
+        if references is not None:
+            references.add(video)
+        if not is_converted(video, os.fsdecode(suffix), args):
+            continue
+        yield (offset + match.start('suffix'),
+                offset + match.end('suffix'),
+                new_suffix)
+
+def find_link_edits(source_file, html_file, args, references=None):
+    """Returns a list of the edits (see link_edits) <html_file>,
+    open (binary) as <source_file>, needs (adding the videos it
+    refers to to <references>.)
+
+    The file is memory mapped so nothing is copied or decoded.
+    Failing that (empty files, file systems without mmap) it is
+    read CHUNK_SIZE bytes at a time, each chunk being cut after its
+    last '>' so that no match straddles two chunks.
+    """
+    try:
+        data = mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        data = None
+    if data is not None:
+        with data:
+            return list(link_edits(data, len(data), 0, html_file, args,
+                                    references))
+    edits = []
+    carry = b''
+    offset = 0
+    while True:
+        chunk = source_file.read(CHUNK_SIZE)
+        data = carry + chunk
+        if chunk:
+            cut = data.rfind(b'>') + 1
+            if not cut:  # No safe place to cut yet.
+                carry = data
+                continue
+        else:
+            cut = len(data)
+        edits.extend(link_edits(data, cut, offset, html_file, args,
+                                references))
+        carry = data[cut:]
+        offset += cut
+        if not chunk:
+            return edits
+
+def write_edits(source_file, destination_file, edits):
+    """Copies <source_file> to <destination_file> (both open in
+    binary mode) applying <edits> (see link_edits) on the way,
+    CHUNK_SIZE bytes at a time."""
+    source_file.seek(0)
+    position = 0
+    for start, end, replacement in edits + [(None, None, b'')]:
+        while start is None or position < start:
+            size = CHUNK_SIZE
+            if start is not None:
+                size = min(size, start - position)
+            data = source_file.read(size)
+            if not data:
+                break
+            destination_file.write(data)
+            position += len(data)
+        if start is not None:
+            destination_file.write(replacement)
+            source_file.seek(end)
+            position = end
+
+def clone_file(source, destination):
+    """Copies <source> to <destination>, data and metadata (as does
+    shutil.copy2,) without passing the data through Python.
+
+    os.copy_file_range lets the kernel (and file system) do the
+    work; os.sendfile is used where that isn't available.
+    """
+    with open(source, 'rb') as source_file, \
+            open(destination, 'wb') as destination_file:
+        size = os.fstat(source_file.fileno()).st_size
+        copied = 0
+        for copy in ('copy_file_range', 'sendfile'):
+            try:
+                while copied < size:
+                    if copy == 'copy_file_range':
+                        sent = os.copy_file_range(source_file.fileno(),
+                                destination_file.fileno(), size - copied)
+                    else:
+                        sent = os.sendfile(destination_file.fileno(),
+                                source_file.fileno(), copied,
+                                size - copied)
+                    if not sent:
+                        break
+                    copied += sent
+                break
+            except (AttributeError, OSError):
+                continue
+        else:
+            source_file.seek(copied)
+            shutil.copyfileobj(source_file, destination_file)
+    shutil.copystat(source, destination)
+
+def reflink_file(source, destination):
+    """Makes <destination> share <source>'s data (copy on write.)
+
+    Only file systems such as btrfs and xfs support this; OSError is
+    raised (and no destination left behind) if it can't be done.
+    """
+    try:
+        with open(source, 'rb') as source_file, \
+                open(destination, 'wb') as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE,
+                        source_file.fileno())
+    except OSError:
+        if os.path.lexists(destination):
+            os.remove(destination)
+        raise
+    shutil.copystat(source, destination)
+
+def place_file(source, destination, args):
+    """Puts an unchanged copy of <source> at <destination> as
+    specified by args['--link-mode'], falling back to clone_file
+    whenever linking isn't possible.
+
+    A symbolic link is always copied as a link (see [1].)
+    Counts, per method actually used, files, bytes and time taken
+    in args['link_stats'] for the final report.
+    """
+    begin = time.perf_counter()
+    mode = args['--link-mode']
+    if mode == 'auto':
+        try:
+            same_device = (os.stat(source).st_dev ==
+                    os.stat(os.path.dirname(destination)).st_dev)
+        except OSError:
+            same_device = False
+        candidates = ('reflink', 'hardlink') if same_device else ()
+    elif mode == 'copy':
+        candidates = ()
+    else:
+        candidates = (mode,)
+    if os.path.islink(source):
+        shutil.copyfile(source, destination, follow_symlinks=False)
+        method = 'link copied'
+    else:
+        for method in candidates:
+            try:
+                if method == 'reflink':
+                    reflink_file(source, destination)
+                elif method == 'hardlink':
+                    os.link(source, destination)
+                else:
+                    os.symlink(source, destination)
+                break
+            except OSError as error:
+                debug("  {} of {} failed: {}".format(method, source,
+                                                    error), args)
+        else:
+            clone_file(source, destination)
+            method = 'copy'
+    size = os.stat(source, follow_symlinks=False).st_size
+    with args['lock']:
+        stats = args['link_stats'].setdefault(method,
+                                    dict(n=0, bytes=0, seconds=0.0))
+        stats['n'] += 1
+        stats['bytes'] += size
+        stats['seconds'] += time.perf_counter() - begin
+
+def modify_html(source, destination, args, references=None,
+                refresh=False):
     """Modifies the text in .html files.
     
-    Changes each instance of '.mp4' in source to the suffix appropriate
-    to args['--format'] in destination.
+    Changes links to converted '.mp4' (and other proprietary) videos
+    in source to the suffix appropriate to args['--format'] in
+    destination counting them in args['n_links'].
+    The file is dealt with as bytes (see find_link_edits) and the
+    modified version written under a temporary name before being
+    renamed to destination.
     Returns True if modifications were necessary, False if not.
     If modifications are not necessary, still moves source to
-    destination unless its already there or args['--in-place'] is
-    set to True (efectively the same thing.)
-    """
-    with open(source, 'r', encoding=ENCODING) as source_file:
-        file_content = source_file.read()
-        content = convert_text(file_content, 
-                                args['proprietary_suffixes'],
-                                args['new_suffix'],)
-    if content:
-        with open(destination, 'w', 
-                    encoding=ENCODING) as destination_file:
-            destination_file.write(content)
-        shutil.copymode(source, destination, follow_symlinks=False)
+    destination (see place_file) unless its already there or
+    args['--in-place'] is set to True (efectively the same thing.)
+    If <refresh>, one already there is replaced (it may have links to
+    a conversion that has since failed.)
+    The videos source refers to are added to <references>.
+    """
+    directory = os.path.dirname(source)
+    with open(source, 'rb') as source_file:
+        with timed('html_read', args, directory):
+            edits = find_link_edits(source_file, source, args,
+                                    references)
+        if edits:
+            temporary = partial_name(destination)
+            with timed('html_rewrite', args, directory):
+                with open(temporary, 'wb') as destination_file:
+                    write_edits(source_file, destination_file, edits)
+    if edits:
+        with args['lock']:
+            args['n_links'] += len(edits)
+        with timed('html_write', args, directory):
+            shutil.copymode(source, temporary, follow_symlinks=False)
+            os.replace(temporary, destination)
         return True
     else:  # file doesn't require changes.
-        if args['--in-place'] or os.path.isfile(destination):
+        if args['--in-place'] or (os.path.isfile(destination)
+                                    and not refresh):
             return   # returns None vs True or False
         else:  # Unchanged file needs to be moved over.
-            shutil.copy2(source, destination) 
+            with timed('html_write', args, directory):
+                if os.path.lexists(destination):
+                    os.remove(destination)
+                place_file(source, destination, args)
             return False
 
+def get_figures(counters):
+    """Derives the figures reported for one proprietary suffix.
+
+    <counters> is one of the args[suffix] dictionaries.
+    Returns a dictionary with keys 'size_increase',
+    'relative_size_increase', 'average_time' and
+    'time_per_meg_of_original_size'.
+    """
+    size_increase = counters.new_size - counters.old_size
+    if size_increase:
+        relative_size_increase = size_increase / counters.old_size
+    else:
+        relative_size_increase = 0
+    if counters.n_converted:
+        average_time = counters.time_delta / counters.n_converted
+    else:
+        average_time = 0
+    if counters.old_size:
+        time_per_meg_of_original_size = (counters.time_delta /
+                                    (counters.old_size / 1000000))
+    else:
+        time_per_meg_of_original_size = 0
+    return dict(size_increase=size_increase,
+                relative_size_increase=relative_size_increase,
+                average_time=average_time,
+                time_per_meg_of_original_size=
+                                    time_per_meg_of_original_size)
+
+def format_counters(proprietary_format, counters):
+    """Returns the report paragraph for one proprietary suffix.
+
+    <counters> is in the form of args[proprietary_format].
+    """
+    figures = get_figures(counters)
+#   if not counters.old_size:
+#       additional_report += "\n.. so time per meg is meaningless."
+    return """{} files encountered: {}, of which {} were converted
+                                     ({} more served from the cache)
+                                     but {} failed.
+    taking a total time of {} 
+        Avg time/file: {}; time/meg of original format: {}.
+        Time spent on failures: {}.
+    Total file space- originals: {:,}, 
+                    conversions: {:,}
+    for an over all size increase of: {:,}, ({:.1%}.)""".format(
+            proprietary_format,
+            counters.n_encountered,
+            counters.n_converted,
+            counters.n_cached,
+            counters.n_failed,
+            str(counters.time_delta)[:-7],
+            str(figures['average_time'])[:-7],
+            str(figures['time_per_meg_of_original_size'])[:-7],
+            str(counters.time_wasted).split('.')[0],
+            counters.old_size,
+            counters.new_size,
+            figures['size_increase'],
+            figures['relative_size_increase'],
+            )
+
 def get_report(args):
     """Returns a report regarding data aquired during execution
-    and stored in args."""
+    and stored in args.
+    
+    If a state database is open, the report goes on to cover every
+    conversion it records, i.e. those of all runs to date."""
     ret = ("""
-Number of html files examined: {}, of which {} were modified. """
-                        .format(args['n_html'], args['n_changed']))
+Number of html files examined: {}, of which {} were modified. 
+Number of links to videos rewritten: {}."""
+                        .format(args['n_html'], args['n_changed'],
+                                args['n_links']))
+    if args['--skip-unchanged']:
+        ret = '\n'.join((ret, "Unchanged directories skipped: {}."
+                                .format(args['n_skipped_dirs'])))
+    if args['--incremental-html']:
+        ret = '\n'.join((ret, "Unchanged html files skipped: {}."
+                                .format(args['n_html_skipped'])))
     for proprietary_format in args['proprietary_suffixes']:
-        size_increase = (args[proprietary_format]['new_size']
-                        - args[proprietary_format]['old_size'])
-        if size_increase:
-            relative_size_increase = (size_increase / 
-                            args[proprietary_format]['old_size'])
+        ret = '\n'.join((ret, format_counters(proprietary_format,
+                                        args[proprietary_format])))
+    if args['state'] is not None:
+        history = get_history(args)
+        ret = '\n'.join((ret, """
+All runs recorded in {}:""".format(args['--state'])))
+        for proprietary_format in args['proprietary_suffixes']:
+            ret = '\n'.join((ret, format_counters(proprietary_format,
+                                        history[proprietary_format])))
+    if args['prober'] or args['--max-growth'] is not None:
+        probe_stats = args['probe_stats']
+        ret = '\n'.join((ret, """Probed ({}): {}, of which {} unreadable and {} audio only.
+Conversions given up for outgrowing their source: {}."""
+                .format(args['prober'], probe_stats['probed'],
+                        probe_stats['unreadable'],
+                        probe_stats['audio_only'],
+                        probe_stats['outgrown'])))
+    space_stats = args['space_stats']
+    if any(space_stats.values()) or args['--delete-originals']:
+        ret = '\n'.join((ret, """Space on {}: {} waits, {} conversions given up for lack of room,
+    {} originals deleted freeing {:,} bytes."""
+                .format(args['--output'], space_stats['pauses'],
+                        space_stats['no_room'], space_stats['deleted'],
+                        space_stats['bytes_freed'])))
+    if args['--cache-dir']:
+        cache_stats = args['cache_stats']
+        ret = '\n'.join((ret, """Conversion cache {}:
+    hits: {}, misses: {}, bytes served: {:,}, entries evicted: {}"""
+                .format(args['--cache-dir'], cache_stats['hits'],
+                        cache_stats['misses'],
+                        cache_stats['bytes_served'],
+                        cache_stats['evicted'])))
+    if args['link_stats']:
+        ret = '\n'.join((ret, get_link_report(args)))
+    return ret
+
+def get_link_report(args):
+    """Returns the part of the report dealing with files placed
+    unchanged in OUT_DIR (see place_file.)
+
+    Bytes saved are those that linking spared from being written.
+    The time saved is estimated from the rate at which files were
+    copied (so is only available if some were.)
+    """
+    copied = args['link_stats'].get('copy')
+    if copied and copied['seconds']:
+        copy_rate = copied['bytes'] / copied['seconds']
+    else:
+        copy_rate = None
+    ret = "Files placed unchanged in {}:".format(args['--output'])
+    for method, stats in sorted(args['link_stats'].items()):
+        line = "    {:12} {:7,} files, {:15,} bytes in {:.1f}s".format(
+                    method + ':', stats['n'], stats['bytes'],
+                    stats['seconds'])
+        if method in ('reflink', 'hardlink', 'symlink'):
+            line += "; saved {:,} bytes".format(stats['bytes'])
+            if copy_rate:
+                line += " and about {:.1f}s".format(max(0,
+                        stats['bytes'] / copy_rate - stats['seconds']))
+        ret = '\n'.join((ret, line))
+    return ret
+
+def plan_work(args):
+    """Scans args['--input'] and returns a manifest of the work to
+    be done without doing any of it.
+
+    The manifest is a dictionary with keys:
+        'directories': a list of (source_dir, dest_dir) tuples,
+        'files': a list, in walk order, of dictionaries each
+            describing one file with keys 'kind' (one of 'html',
+            'video' or 'copy'), 'file_name', 'source', 'destination',
+            'size' (of the source; html entries also have its
+            'mtime') and 'exists' (True if destination
+            is already present- for videos: if the state database
+            shows it to be completely converted.)  Video entries
+            have in addition the keys 'suffix' and 'dest_if_fail'
+            (where the unconverted file goes if conversion fails.)
+    Files to be left as they are (non html non video files when
+    working in place) are not included.
+    """
+    manifest = dict(directories=[], files=[])
+    for kind, entry in scan_items(args):
+        if kind == 'directory':
+            manifest['directories'].append(entry)
         else:
-            relative_size_increase = 0
-        if args[proprietary_format]['n_converted']:
-            average_time = (args[proprietary_format]['time_delta'] /
-                            args[proprietary_format]['n_converted'])
+            manifest['files'].append(entry)
+    return manifest
+
+def scan_items(args):
+    """Walks args['--input'] (see scan_tree) generating, in walk
+    order, a ('directory', (source_dir, dest_dir)) tuple for each
+    directory followed by a ('file', item) tuple for each of its
+    files that needs dealing with, items being as described in
+    plan_work.
+
+    With args['--skip-unchanged'], the files of a directory that
+    is_unchanged_directory reports on favourably are not looked at.
+    The videos of each directory whose files are looked at are kept
+    in args['scanned_dirs'] (see record_directories.)
+    """
+    for source_dir, entries in scan_tree(args['--input'], args):
+        debug("Scanning {}".format(source_dir), args)
+        dest_dir = destination_of(source_dir, args)
+        yield 'directory', (source_dir, dest_dir)
+        if (args['--skip-unchanged']
+                and is_unchanged_directory(source_dir, dest_dir, args)):
+            debug("  Unchanged since last run, skipped.", args)
+            args['n_skipped_dirs'] += 1
+            continue
+        videos = args['scanned_dirs'][(source_dir, dest_dir)] = []
+        if args['--in-place']:
+            present = set(entry.name for entry in entries)
+        else:
+            present = listed_files(dest_dir)
+        for entry in entries:
+            file_name = entry.name
+            source = entry.path
+            destination = os.path.join(dest_dir, file_name)
+            kind, suffix = classify(file_name, args['--in-place'],
+                                    args['html_suffix'],
+                                    args['proprietary_suffixes'])
+            if kind == 'video':
+                try:
+                    entry.stat()  # Kept by entry for the size below.
+                except FileNotFoundError:  # A broken link (see [1].)
+                    kind = None if args['--in-place'] else 'copy'
+            if kind is None:
+                continue
+            item = dict(kind=kind,
+                        file_name=file_name,
+                        source=source,
+                        destination=destination)
+            if kind == 'video':
+                item['suffix'] = suffix
+                item['dest_if_fail'] = destination
+                item['destination'] = converted_name(destination, suffix,
+                                                    args['new_suffix'])
+                videos.append(item)
+            with timed('stat', args, source_dir):
+                # A linked video's size is that of the video.
+                info = entry.stat(follow_symlinks=item['kind'] == 'video')
+                item['size'] = info.st_size
+                if item['kind'] == 'html':
+                    item['mtime'] = info.st_mtime_ns
+                if item['kind'] == 'video':
+                    # An existing destination may be a partial
+                    # conversion so only the state database can be
+                    # trusted.
+                    item['exists'] = is_done(item, args)
+                else:
+                    # A broken link counts as present (see [1].)
+                    item['exists'] = file_name in present
+            yield 'file', item
+
+def listed_files(directory):
+    """Returns the set of names of the non directory entries
+    (symbolic links included, broken or not) of <directory>: empty
+    if it doesn't exist."""
+    try:
+        with os.scandir(directory) as it:
+            return set(entry.name for entry in it
+                        if not entry.is_dir(follow_symlinks=False))
+    except FileNotFoundError:
+        return set()
+
+def order_videos(videos, args):
+    """Returns the video entries of a manifest in the order
+    specified by args['--order'].
+
+    'largest' (largest first) keeps a pool of concurrent conversions
+    busy until the end; 'smallest' gets the most files done early;
+    'walk' keeps the order in which they were found.
+    """
+    if args['--order'] == 'walk':
+        return list(videos)
+    return sorted(videos, key=lambda item: item['size'],
+                    reverse=(args['--order'] == 'largest'))
+
+def estimate_duration(manifest, args):
+    """Estimates how long the pending conversions of a manifest
+    will take.
+
+    Uses the same time/meg of original format figure that get_report
+    provides, taken from the conversions counted so far in this run,
+    or failing that from the history kept in the state database,
+    or failing that args['--time-per-meg'] (seconds.)
+    Returns a datetime.timedelta.
+    """
+    default_rate = datetime.timedelta(seconds=args['--time-per-meg'])
+    history = get_history(args)
+    total = datetime.timedelta(0)
+    for item in manifest['files']:
+        if item['kind'] == 'video' and not item['exists']:
+            rate = (get_figures(args[item['suffix']]
+                                )['time_per_meg_of_original_size']
+                    or get_figures(history[item['suffix']]
+                                )['time_per_meg_of_original_size']
+                    or default_rate)
+            total += rate * (item['size'] / 1000000)
+    return total / args['--jobs']
+
+def get_plan_report(manifest, args):
+    """Returns a listing of what executing <manifest> would do
+    followed by a summary with an estimated duration.
+
+    Uses the same markers as the log:
+    $ destination already exists, + html to be checked/rewritten,
+    - file to be copied, => video to be converted.
+    """
+    lines = []
+    n_pending = pending_size = 0
+    for item in order_videos([item for item in manifest['files']
+                                if item['kind'] == 'video'], args):
+        if item['exists']:
+            lines.append("{} $".format(item['destination']))
         else:
-            average_time = 0
-        if args[proprietary_format]['old_size']:
-            time_per_meg_of_original_size = (
-                    args[proprietary_format]['time_delta'] /
-                    (args[proprietary_format]['old_size'] / 1000000))
+            n_pending += 1
+            pending_size += item['size']
+            lines.append("{} ({:,}) => {}".format(item['source'],
+                                        item['size'], args['--format']))
+    for item in manifest['files']:
+        if item['kind'] == 'video':
+            continue
+        if item['exists'] and not args['--in-place']:
+            lines.append("{} $".format(item['destination']))
+        elif item['kind'] == 'html':
+            lines.append("{} +".format(item['source']))
         else:
-            time_per_meg_of_original_size = 0
-#           additional_report += "\n.. so time per meg is meaningless."
-        ret = '\n'.join((ret, 
-        """{} files encountered: {}, of which {} were converted
-                                     but {} failed.
-    taking a total time of {} 
-        Avg time/file: {}; time/meg of original format: {}.
-    Total file space- originals: {:,}, 
-                    conversions: {:,}
-    for an over all size increase of: {:,}, ({:.1%}.)"""
-    .format(proprietary_format,
-            args[proprietary_format]['n_encountered'],
-            args[proprietary_format]['n_converted'],
-            args[proprietary_format]['n_failed'],
-            str(args[proprietary_format]['time_delta'])[:-7],
-            str(average_time)[:-7],
-            str(time_per_meg_of_original_size)[:-7],
-            args[proprietary_format]['old_size'],
-            args[proprietary_format]['new_size'],
-            size_increase,
-            relative_size_increase,
-            )))
-    return ret
-        
+            lines.append("{} -".format(item['source']))
+    lines.append("""
+Directories: {}; files: {}, of which {} are html.
+Videos to convert: {} ({:,} bytes) using {} job(s), '{}' first.
+Estimated duration: {}""".format(
+            len(manifest['directories']),
+            len(manifest['files']),
+            len([item for item in manifest['files']
+                    if item['kind'] == 'html']),
+            n_pending, pending_size,
+            args['--jobs'], args['--order'],
+            str(estimate_duration(manifest, args)).split('.')[0]))
+    return '\n'.join(lines)
+
+def process_html(item, args):
+    """Deals with an html entry of a manifest, logging the outcome."""
+# Algorithm:-----------------------------------------------------------
+#                     |   Modified             |   Not Modified        |
+# =====================================================================
+#      In Place       |  over write source +   |    do nothing -       |
+# ---------------------------------------------------------------------
+#   Not in place:                                                      |
+#      Exists in dest |     do nothing $       |    do nothing $       |
+# ----------------------------------------------------------------------
+#      Does not exist | write to destination + | copy to destination - |
+# ----------------------------------------------------------------------
+# $ destination already existed.
+# + modified.
+# - no need for modification.
+    with args['lock']:
+        args['n_html'] += 1
+    references = set()
+    html_modified = modify_html(item['source'], item['destination'],
+                                args, references, item.get('refresh'))
+    record_page(item, references, args)
+    if item['exists'] and not args['--in-place']:
+        marker = '$'
+    elif html_modified:
+        # modify_html has already written to source or destination.
+        with args['lock']:
+            args['n_changed'] += 1
+        marker = '+'
+    else:
+        # Source has, if need be, already been copied to
+        # destination by the modify_html function.
+        marker = '-'
+    log("{}: {} {}".format(str(datetime.datetime.now())[:19],
+                            item['file_name'], marker), args)
+
+def process_copy(item, args):
+    """Deals with a 'copy' entry of a manifest."""
+    if not item['exists']:
+        with timed('copy', args, os.path.dirname(item['source'])):
+            place_file(item['source'], item['destination'], args)
+
+def make_directory(directory, args):
+    """Creates, if need be, the destination of a manifest
+    directory entry (a (source_dir, dest_dir) tuple.)"""
+    source_dir, dest_dir = directory
+    message = "Traversing {}".format(source_dir)
+    debug(message, args)
+    log(message, args)
+    if not os.path.isdir(dest_dir):
+        debug("  Having to create {}".format(dest_dir), args)
+        os.mkdir(dest_dir)
+        shutil.copymode(source_dir, dest_dir, follow_symlinks=False)
+
+def process_item(item, args):
+    """Deals with an html or copy entry of a manifest."""
+    debug("    Checking {}".format(item['file_name']), args)
+    if item['kind'] == 'html':
+        status("Checking {}".format(item['source']), args)
+        process_html(item, args)
+    else:
+        process_copy(item, args)
+    advance_progress(args)
+
+def execute_plan(manifest, args):
+    """Does the work described by <manifest> (see plan_work.)
+
+    Directories are created first.  Videos are then queued on a
+    pool of at most args['--jobs'] background conversions in the
+    order given by order_videos while plain copies are dealt with in
+    walk order.  Html files (see select_pages) are left until the
+    videos are done so their links reflect what was converted.
+    Progress is followed in args['progress'] (see start_progress.)
+    """
+    start_progress(manifest, args)
+    for directory in manifest['directories']:
+        make_directory(directory, args)
+    pool = dict(pending=collections.deque(), running=[], waiting={})
+    for item in order_videos([item for item in manifest['files']
+                                if item['kind'] == 'video'], args):
+        args[item['suffix']].n_encountered += 1
+        if item['exists']:  # Already converted.
+            log_existing(item, args)
+        else:
+            pool['pending'].append(item)
+    for item in manifest['files']:
+        service_conversions(pool, args)
+        if item['kind'] == 'copy':
+            process_item(item, args)
+    service_conversions(pool, args, wait=True)
+    for item in select_pages([item for item in manifest['files']
+                                if item['kind'] == 'html'], args):
+        process_item(item, args)
+    show_progress(args, final=True)
+
+def log_existing(item, args):
+    """Counts and logs a manifest video entry found to be already
+    converted."""
+    log("{}: {} $".format(str(datetime.datetime.now())[:19],
+                        os.path.basename(item['destination'])), args)
+    advance_progress(args)
+
+async def encode_async(job, in_flight, running, args):
+    """Converts the manifest video entry <job> using an asyncio
+    subprocess, or the cache (see service_conversions for the
+    equivalent in the pool engine.)
+
+    <in_flight> maps the cache key of each conversion running to an
+    asyncio.Event set when it finishes; a job with the same key
+    waits for it.
+    <running> is the list of the jobs being encoded: a job only
+    starts once there is room for it besides them (see get_budget.)
+    If cancelled, the encoder is killed and its output removed.
+    Everything that reads or copies files or writes to the state
+    database (preparing the job, the cache, recording the conversion)
+    is done in the default executor so as not to hold up the other
+    encoders.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, prepare_job, job, args):
+        return
+    key = job.get('cache_key')
+    if key:
+        while key in in_flight:
+            await in_flight[key].wait()
+        in_flight[key] = asyncio.Event()
+    try:
+        if key and await loop.run_in_executor(None, satisfy_from_cache,
+                                                job, args):
+            return
+        while estimate_output(job, args) > get_budget(running, args):
+            if not running:
+                with args['lock']:
+                    args['space_stats']['no_room'] += 1
+                await loop.run_in_executor(None, record_conversion,
+                                            job, SPACE_FAILURE, args)
+                return
+            note_pause(True, args)
+            await asyncio.sleep(POLL_INTERVAL)
+        note_pause(False, args)
+        running.append(job)
+        try:
+            await loop.run_in_executor(None, set_state, job, 'encoding',
+                                        args)
+            command_line = get_command_line(job['source'], job['partial'],
+                                            args, job.get('audio_only'))
+            with timed('encoder_spawn', args,
+                        os.path.dirname(job['source'])):
+                process = await asyncio.create_subprocess_exec(
+                                                        *command_line)
+            try:
+                return_code = None
+                while return_code is None:
+                    try:
+                        return_code = await asyncio.wait_for(
+                                        process.wait(), POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        if has_outgrown(job, args):
+                            process.kill()
+                            await process.wait()
+                            return_code = GROWTH_FAILURE
+            except asyncio.CancelledError:
+                # Nothing here may be awaited before the clean up is
+                # done since the task may be cancelled again.
+                if process.returncode is None:
+                    process.kill()
+                if os.path.lexists(job['partial']):
+                    os.remove(job['partial'])
+                log("Interrupted: {}".format(job['source']), args)
+                raise
+        finally:
+            running.remove(job)
+        await loop.run_in_executor(None, record_conversion,
+                                    job, return_code, args)
+    finally:
+        if key:
+            in_flight.pop(key).set()
+
+async def encode_stage(queue, in_flight, running, args):
+    """Takes manifest video entries from <queue> and converts them
+    until it gets None."""
+    while True:
+        job = await queue.get()
+        if job is None:
+            return
+        args[job['suffix']].n_encountered += 1
+        if job['exists']:  # Already converted.
+            log_existing(job, args)
+        else:
+            await encode_async(job, in_flight, running, args)
+
+async def io_stage(queue, executor, args):
+    """Takes html and copy entries from <queue> and has <executor>
+    deal with them (see process_item) until it gets None."""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        await loop.run_in_executor(executor, process_item, item, args)
+
+async def run_pipeline(args):
+    """The async engine: does the work traverse_and_change describes
+    as a pipeline.
+
+    The walk (see scan_items) runs in a thread of its own, creating
+    directories as it goes and feeding two bounded queues: one of
+    videos for args['--jobs'] encode_stage tasks, one of copies for
+    IO_THREADS io_stage tasks.  Html files need to know which videos
+    were converted so are only queued (see select_pages) once the
+    encoders are done.  Cancelling (Ctrl-C) cancels every stage, which kills the
+    running encoders.
+    """
+    import asyncio
+    import concurrent.futures
+    loop = asyncio.get_running_loop()
+    videos = asyncio.Queue(QUEUE_SIZE)
+    files = asyncio.Queue(QUEUE_SIZE)
+    html_items = []
+    stopping = threading.Event()
+    start_progress(dict(files=[]), args)
+
+    def put(queue, item):
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                return future.result(POLL_INTERVAL)
+            except concurrent.futures.TimeoutError:
+                if stopping.is_set():
+                    future.cancel()
+                    raise concurrent.futures.CancelledError
+
+    def produce():
+        for kind, entry in scan_items(args):
+            if stopping.is_set():
+                return
+            if kind == 'directory':
+                make_directory(entry, args)
+                continue
+            add_to_progress(entry, args)
+            if entry['kind'] == 'video':
+                put(videos, entry)
+            elif entry['kind'] == 'html':
+                html_items.append(entry)
+            else:
+                put(files, entry)
+
+    executor = concurrent.futures.ThreadPoolExecutor(IO_THREADS)
+    in_flight = {}
+    running = []
+    encoders = [asyncio.create_task(encode_stage(videos, in_flight,
+                                                running, args))
+                for _ in range(args['--jobs'])]
+    stages = encoders + [asyncio.create_task(io_stage(files, executor,
+                                                    args))
+                            for _ in range(IO_THREADS)]
+    try:
+        await loop.run_in_executor(None, produce)
+        for _ in range(args['--jobs']):
+            await videos.put(None)
+        await asyncio.gather(*encoders)
+        for item in await loop.run_in_executor(None, select_pages,
+                                                html_items, args):
+            await files.put(item)
+        for _ in range(IO_THREADS):
+            await files.put(None)
+        await asyncio.gather(*stages)
+    except BaseException:
+        stopping.set()
+        for stage in stages:
+            stage.cancel()
+        await asyncio.gather(*stages, return_exceptions=True)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        show_progress(args, final=True)
+
+def write_json(data, path):
+    """Writes <data> as JSON to <path>, atomically (so a reader on
+    another machine never sees part of it.)"""
+    temporary = partial_name(path)
+    with open(temporary, 'w') as f:
+        json.dump(data, f)
+    os.replace(temporary, path)
+
+def read_json(path):
+    """Returns the data in the JSON file <path> or None if it has
+    gone (been moved by another process.)"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return
+
+def queue_paths(queue_dir):
+    """Returns a dictionary of the sub directories of <queue_dir>
+    ('pending', 'leased', 'done') and of its 'config' and
+    'finished' files."""
+    paths = {name: os.path.join(queue_dir, name)
+                for name in ('pending', 'leased', 'done')}
+    paths['config'] = os.path.join(queue_dir, 'config.json')
+    paths['finished'] = os.path.join(queue_dir, 'finished')
+    return paths
+
+def requeue_expired(paths, args):
+    """Puts back in pending the leased jobs not touched by their
+    worker for args['--lease-timeout'] seconds."""
+    now = time.time()
+    for entry in os.scandir(paths['leased']):
+        try:
+            expired = (now - entry.stat().st_mtime
+                        > args['--lease-timeout'])
+            if expired:
+                os.rename(entry.path,
+                            os.path.join(paths['pending'], entry.name))
+                log("Lease expired, job requeued: {}".format(
+                                                    entry.name), args)
+        except FileNotFoundError:  # Finished meanwhile.
+            continue
+
+def remove_worker_partials(job_id, destination):
+    """Removes the partial conversions workers have left (see work)
+    of job <job_id> to <destination>: those of workers that died or
+    whose lease expired."""
+    head, tail = os.path.split(destination)
+    pattern = os.path.join(glob.escape(head), '{}*.{}.{}'.format(
+                glob.escape(PARTIAL_PREFIX), job_id, glob.escape(tail)))
+    for path in glob.glob(pattern):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+def collect_results(paths, outstanding, run, args):
+    """Records (see record_conversion) each result left in done by
+    a worker for a job of this <run> in <outstanding> (a dictionary
+    of jobs keyed by job id) and removes it from there.
+
+    Results for jobs no longer outstanding (converted twice because
+    a lease expired) or of an earlier run are discarded along with
+    their output.  A result whose output has gone is a failure.
+    """
+    for entry in os.scandir(paths['done']):
+        if entry.name.startswith(PARTIAL_PREFIX):
+            continue
+        result = read_json(entry.path)
+        os.remove(entry.path)
+        job = (outstanding.pop(result['id'], None)
+                if result.get('run') == run else None)
+        if job is None:
+            if os.path.lexists(result['partial']):
+                os.remove(result['partial'])
+            continue
+        for directory in ('pending', 'leased'):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(paths[directory], entry.name))
+        job['partial'] = result['partial']
+        job['begin'] = (datetime.datetime.now()
+                        - datetime.timedelta(seconds=result['seconds']))
+        debug("{} converted by {}".format(job['source'],
+                                        result['worker']), args)
+        return_code = result['return_code']
+        if not return_code and not os.path.isfile(job['partial']):
+            return_code = LOST_FAILURE
+        record_conversion(job, return_code, args)
+        remove_worker_partials(result['id'], job['destination'])
+
+def coordinate(manifest, args):
+    """Does the work described by <manifest> (as does execute_plan)
+    except that videos are served, through args['--queue'], to
+    workers (see work) to be converted.
+
+    The coordinator itself deals with the cache, plain copies and,
+    once the videos are done, html files and records the workers'
+    results as they come.
+    Jobs and results left in the queue by an earlier run are
+    removed; those of workers still at it are told apart by the
+    run's (random) id.
+    """
+    paths = queue_paths(args['--queue'])
+    for name in ('pending', 'leased', 'done'):
+        os.makedirs(paths[name], exist_ok=True)
+        for entry in os.scandir(paths[name]):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry.path)
+    if os.path.exists(paths['finished']):
+        os.remove(paths['finished'])
+    run = os.urandom(8).hex()
+    write_json(dict(format=args['--format'], preset=args['--preset'],
+                    max_growth=args['--max-growth'], run=run),
+                paths['config'])
+    start_progress(manifest, args)
+    for directory in manifest['directories']:
+        make_directory(directory, args)
+    outstanding = {}
+    for item in order_videos([item for item in manifest['files']
+                                if item['kind'] == 'video'], args):
+        args[item['suffix']].n_encountered += 1
+        if item['exists']:  # Already converted.
+            log_existing(item, args)
+            continue
+        if not prepare_job(item, args):
+            continue
+        if item.get('cache_key') and satisfy_from_cache(item, args):
+            continue
+        job_id = hashlib.sha1(item['destination'].encode()).hexdigest()
+        remove_worker_partials(job_id, item['destination'])
+        outstanding[job_id] = item
+        set_state(item, 'encoding', args)
+        write_json(dict(id=job_id, run=run, source=item['source'],
+                        destination=item['destination'],
+                        size=item['size'],
+                        audio_only=item.get('audio_only', False)),
+                    os.path.join(paths['pending'], job_id + '.json'))
+    try:
+        for item in manifest['files']:
+            if item['kind'] == 'copy':
+                process_item(item, args)
+        while outstanding:
+            collect_results(paths, outstanding, run, args)
+            requeue_expired(paths, args)
+            show_progress(args)
+            if outstanding:
+                time.sleep(POLL_INTERVAL * 10)
+    finally:
+        with open(paths['finished'], 'w') as f:
+            f.write("{}\n".format(str(datetime.datetime.now())[:19]))
+    for item in select_pages([item for item in manifest['files']
+                                if item['kind'] == 'html'], args):
+        process_item(item, args)
+    show_progress(args, final=True)
+
+def claim_job(paths, args):
+    """Moves a pending job to leased (the rename being what makes
+    the claim safe between workers) and starts its lease.  Returns
+    it or None."""
+    for entry in sorted(os.scandir(paths['pending']),
+                        key=lambda entry: entry.name):
+        if entry.name.startswith(PARTIAL_PREFIX):
+            continue
+        leased = os.path.join(paths['leased'], entry.name)
+        try:
+            os.rename(entry.path, leased)
+            # The rename keeps the mtime from when the job was queued.
+            os.utime(leased)
+        except FileNotFoundError:  # Another worker got it first.
+            continue
+        job = read_json(leased)
+        if job is not None:
+            job['lease'] = leased
+            return job
+
+def finish_job(job, return_code, paths, args):
+    """Leaves the result of <job> in done for the coordinator."""
+    write_json(dict(id=job['id'], run=job.get('run'),
+                    return_code=return_code,
+                    partial=job['partial'], worker=args['--worker-id'],
+                    seconds=time.time() - job['begin']),
+                os.path.join(paths['done'], job['id'] + '.json'))
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(job['lease'])
+
+def work(args):
+    """Worker: converts the jobs served through args['--work'] (see
+    coordinate,) up to args['--jobs'] at a time, using the format
+    and preset the coordinator specifies and this machine's
+    encoder.  Touches each job's lease while converting it.
+    Returns once the coordinator is finished and no job is left.
+    """
+    paths = queue_paths(args['--work'])
+    while read_json(paths['config']) is None:
+        time.sleep(POLL_INTERVAL * 10)
+    config = read_json(paths['config'])
+    args['--format'] = config['format']
+    args['--preset'] = config['preset']
+    args['--max-growth'] = config['max_growth']
+    set_up_encoder(args)
+    running = []
+    n_done = n_failed = 0
+    heartbeat = 0.0
+    while True:
+        for job in list(running):
+            return_code = job['process'].poll()
+            if return_code is None and has_outgrown(job, args):
+                job['process'].kill()
+                job['process'].wait()
+                return_code = GROWTH_FAILURE
+            if return_code is not None:
+                running.remove(job)
+                finish_job(job, return_code, paths, args)
+                n_done += 1
+                if return_code:
+                    n_failed += 1
+                log("{}: {} => {} ({})".format(
+                        str(datetime.datetime.now())[:19],
+                        job['source'], args['--format'], return_code),
+                    args)
+        while len(running) < args['--jobs']:
+            job = claim_job(paths, args)
+            if job is None:
+                break
+            head, tail = os.path.split(job['destination'])
+            job['partial'] = os.path.join(head, '{}{}.{}.{}'.format(
+                PARTIAL_PREFIX, args['--worker-id'], job['id'], tail))
+            job['begin'] = time.time()
+            job['process'] = start_conversion(job['source'],
+                                                job['partial'], args,
+                                                job['audio_only'])
+            running.append(job)
+        if time.time() - heartbeat > args['--lease-timeout'] / 3:
+            heartbeat = time.time()
+            for job in running:
+                with contextlib.suppress(FileNotFoundError):
+                    os.utime(job['lease'])
+        if (not running and os.path.exists(paths['finished'])
+                and not any(os.scandir(paths['pending']))):
+            break
+        time.sleep(POLL_INTERVAL * (10 if not running else 1))
+    return ("Worker {}: {} jobs done of which {} failed."
+                .format(args['--worker-id'], n_done, n_failed))
+
 def traverse_and_change(args):
     """Convert all files found in args['--input']
 
@@ -286,161 +2921,109 @@ def traverse_and_change(args):
     If args['--format'] files are found on the input side, this
     will be logged and, if args['--verbose'], a notification sent
     to stdout.
+    Work is done in two phases: plan_work builds a manifest of
+    everything to be done, execute_plan (or coordinate, if
+    args['--queue'] is set) then carries it out- unless
+    args['--engine'] is 'async' (see run_pipeline.)
+    Progress is kept in the state database (see open_state.)
+    The wall time of each phase is kept in args['phase_times'].
     Depends on log function.
     Returns a final report on what's been done.
     """
-
-    for root, _, files in os.walk(args['--input']):
-        message = "Traversing {}".format(root)
-        debug(message, args)
-        log(message, args)
-        source_dir = os.path.abspath(root)
-        dest_dir = (source_dir
-                    .replace(os.path.abspath(args['--input']),
-                            os.path.abspath(args['--output']), 1))
-
-        if not os.path.isdir(dest_dir):
-            debug("  Having to create {}".format(dest_dir), args)
-            os.mkdir(dest_dir)
-            shutil.copymode(source_dir, dest_dir, follow_symlinks=False)
-#           shutil.copymode(source_dir, dest_dir)
-        for file_name in files:
-# $ destination already existed.
-# + modified.
-# - no need for modification.
-            source = os.path.abspath(os.path.join(root, file_name))
-            destination = os.path.abspath(
-                                os.path.join(dest_dir, file_name))
-            debug("    Checking {}".format(file_name), args)
-# Deal with html files:
-# Algorithm:-----------------------------------------------------------
-#                     |   Modified             |   Not Modified        |
-# =====================================================================
-#      In Place       |  over write source +   |    do nothing -       |
-# ---------------------------------------------------------------------
-#   Not in place:                                                      |
-#      Exists in dest |     do nothing $       |    do nothing $       |
-# ----------------------------------------------------------------------
-#      Does not exist | write to destination + | copy to destination - |
-# ----------------------------------------------------------------------
-            if source.endswith(args['html_suffix']):
-                debug("      which is an html file.", args)
-                args['n_html'] += 1
-                html_modified = modify_html(source, destination, args)
-# $ destination already existed.
-# + modified.
-# - no need for modification.
-                if html_modified:
-                    if args['--in-place']:
-                        # overwrite source
-                        log("{}: {} +"
-                            .format(str(datetime.datetime.now())[:19],
-                                    file_name), args)
-                        args['n_changed'] += 1
-                    else: # not in place
-                        if os.path.isfile(destination): # Already done.
-                            log("{}: {} $"
-                              .format(str(datetime.datetime.now())[:19],
-                                        file_name), args)
-                        else: # Not in Destination:
-                            args['n_changed'] += 1
-                            # write to destination already done
-                            # by the modify_html function.
-                            log("{}: {} +"
-                              .format(str(datetime.datetime.now())[:19],
-                                        file_name), args)
-                else:  # Not modified
-                    if args['--in-place']:
-                        log("{}: {} -"
-                            .format(str(datetime.datetime.now())[:19],
-                                    file_name), args)
-                    else:  # not in place
-                        if os.path.isfile(destination):  # exists in dest
-                            log("{}: {} $"
-                                .format(str(datetime.datetime.now())[:19],
-                                        file_name), args)
-                        else:  # Not in destination
-                            log("{}: {} -"
-                                .format(str(datetime.datetime.now())[:19],
-                                        file_name), args)
-                            # Source has already been copied to
-                            # destination by the modify_html function.
-            elif is_target_video_file(source, args):
-                debug("      which is a video file.", args)
-                # args['current_proprietary_suffix'] is set
-                # by is_target_video_file() function.
-                args[args['current_proprietary_suffix']]\
-                                    ['n_encountered'] += 1
-                dest_file = file_name.replace(
-                                    args['current_proprietary_suffix'],
-                                    args['new_suffix'])
-                dest_if_fail = destination
-                destination = destination.replace(
-                                    args['current_proprietary_suffix'],
-                                    args['new_suffix'])
-                if os.path.isfile(destination):  # Already converted.
-                    log("{}: {} $"
-                            .format(str(datetime.datetime.now())[:19],
-                                                dest_file), args)
-                    continue  
-                begin_conversion = datetime.datetime.now()
-                return_code = convert_video(source, destination, args)
-                end_conversion = datetime.datetime.now()
-                conversion_time = end_conversion - begin_conversion
-                if return_code:
-                    message = ("FAILED ({}) {}"
-                                .format(return_code, source))
-                    print(message)
-                    log(message, args)
-                    args[args['current_proprietary_suffix']]\
-                        ['time_wasted'] += conversion_time
-                    args[args['current_proprietary_suffix']]\
-                                        ['n_failed'] += 1
-                    if not args['--in-place']:  # Copy unconverted file:
-                        if not os.path.isfile(dest_if_fail):
-                            shutil.copyfile(source, 
-                                            dest_if_fail,
-                                            follow_symlinks=False)
-                    continue
-                else:
-                    log("{}: {} => {}"
-                            .format(str(datetime.datetime.now())[:19],
-                                    file_name,
-                                    args['--format']),
-                        args)
-                    args[args['current_proprietary_suffix']]\
-                                        ['n_converted'] += 1
-                    args[args['current_proprietary_suffix']]\
-                        ['time_delta'] += conversion_time
-                    args[args['current_proprietary_suffix']]\
-                        ['old_size'] += os.stat(source).st_size
-                    args[args['current_proprietary_suffix']]\
-                        ['new_size'] += os.stat(destination).st_size
-            elif not args['--in-place']: 
-                if not (os.path.isfile(destination)  # [1]
-                  or os.path.islink(destination)):
-                    shutil.copyfile(source, 
-                                    destination,
-                                    follow_symlinks=False)
+    open_state(args)
+    try:
+        load_link_index(args)
+        begin = time.perf_counter()
+        if args['--engine'] == 'async':
+            import asyncio  # Slow to import so only when needed.
+            asyncio.run(run_pipeline(args))
+            args['phase_times']['pipeline'] = time.perf_counter() - begin
+        else:
+            manifest = plan_work(args)
+            args['phase_times']['plan'] = time.perf_counter() - begin
+            begin = time.perf_counter()
+            if args['--queue']:
+                coordinate(manifest, args)
             else:
-                debug("      which we'll leave as is.",args)
-    ret = get_report(args)
+                execute_plan(manifest, args)
+            args['phase_times']['execute'] = (time.perf_counter()
+                                                - begin)
+        record_directories(args)
+        ret = get_report(args)
+    finally:
+        close_state(args)
     log(ret, args)
+    if args['--profile']:
+        log("Profile written to {}".format(write_profile(args)), args)
     return ret
 
+def dry_run(args):
+    """Returns what traverse_and_change would do for <args> (see
+    get_plan_report) having done none of it."""
+    open_state(args, read_only=True)
+    try:
+        return get_plan_report(plan_work(args), args)
+    finally:
+        close_state(args)
+
+def convert(config):
+    """Does, for <config> (a Config,) what the command line does:
+    converts the videos under config.input and fixes the links to
+    them (see traverse_and_change,) or only reports what would be
+    done (dry_run,) the profiles available (list_profiles) or works
+    for a coordinator (work.)  Logging is as specified by <config>
+    but signals are left alone.
+
+    Returns the report and a dictionary of the Stats of each
+    proprietary suffix.  Raises ConfigError if <config> can't be
+    used.
+    """
+    args = set_up_args(config.to_args())
+    if args['--list-profiles']:
+        ret = get_profile_listing(args)
+    elif args['--dry-run']:
+        ret = dry_run(args)
+    else:
+        start_logging(args, handle_signals=False)
+        try:
+            if args['--work']:
+                ret = work(args)
+                log(ret, args)
+            else:
+                ret = traverse_and_change(args)
+        finally:
+            stop_logging(args)
+    return ret, {suffix: args[suffix]
+                    for suffix in args['proprietary_suffixes']}
+
 def main(args):
+    if args['--list-profiles']:
+        print(get_profile_listing(args))
+        return
+    if args['--work']:
+        start_logging(args)
+        summary = work(args)
+        log(summary, args)
+        stop_logging(args)
+        print(summary)
+        return
+    if args['--dry-run']:
+        print(dry_run(args))
+        return
     if args['--verbose'] or args['--debug']:
         response = input(
         """Root directory of files to be converted is set to..
         {in_dir}
         Output is set to go to..
         {out_dir}
-        Format chosen is {form}.
+        Format chosen is {form} ({preset}) using {encoder}.
         Log file is set to: {log_file}.
         Status file is set to: {status_file}.
         OK to proceed? (y/n): """.format(in_dir=args['--input'],
                                         out_dir=args['--output'],
                                         form=args['--format'],
+                                        preset=args['--preset'],
+                                        encoder=args['encoder'],
                                         log_file=args['--logfile'],
                                         status_file=args['--statusfile'],
                                         ))
@@ -449,19 +3032,26 @@ def main(args):
     "Re-run the script with desired parameters.")
             sys.exit(0)
 
+    start_logging(args)
     message = ("""
 ####   Beginning new instance of format_change.py {}"""\
                             .format(str(datetime.datetime.now())[:19]))
     log(message, args)
     if args['--verbose'] or args['--debug']:
         print(message)
-    summary_report = traverse_and_change(args)
+    if args['--cprofile']:
+        profiler = cProfile.Profile()
+        summary_report = profiler.runcall(traverse_and_change, args)
+        profiler.dump_stats(args['--logfile'] + '.pstats')
+    else:
+        summary_report = traverse_and_change(args)
     if args['--verbose'] or args['--debug']:
         print(summary_report)
     message = ("""
 ####   Ending current instance of format_change.py {}"""\
                             .format(str(datetime.datetime.now())[:19]))
     log(message, args)
+    stop_logging(args)
     if args['--verbose'] or args['--debug']:
         print(message)
 